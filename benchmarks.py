@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+#encoding=utf-8
+# Copyright (c) 2013 Billogram AB
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Benchmarks for the Billogram API client library
+
+These run entirely offline, requests are made to the local stand-in in
+billogram_standin. Run all benchmarks with:
+
+    python benchmarks.py
+
+or only those whose names start with any of the given prefixes:
+
+    python benchmarks.py decode
+
+Results can be saved and later compared to, exiting with status 1 if any
+result got worse by more than the tolerance (10% by default):
+
+    python benchmarks.py --save baseline.json
+    python benchmarks.py --compare baseline.json --tolerance 0.2
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import io
+import json
+import sys
+import time
+import timeit
+
+import requests
+
+import billogram_api
+from billogram_standin import StandinServer
+
+
+BENCHMARKS = []
+
+# measured results by name, as (value, True if higher is better)
+RESULTS = {}
+
+
+def benchmark(func):
+    "Register a benchmark function"
+    BENCHMARKS.append(func)
+    return func
+
+
+def make_billogram(n):
+    "Make a compact billogram object like the ones in query results"
+    return {
+        'id': 'bg{:08d}'.format(n),
+        'invoice_no': n,
+        'ocr_number': '{:012d}'.format(n * 7),
+        'state': 'Unpaid',
+        'currency': 'SEK',
+        'total_sum': 1250.0 + n,
+        'remaining_sum': 1250.0 + n,
+        'invoice_date': '2013-05-01',
+        'due_date': '2013-05-31',
+        'created_at': '2013-05-01 12:00:00',
+        'updated_at': '2013-05-01 12:00:00',
+        'customer': {
+            'customer_no': n % 1000,
+            'name': 'Customer number {}'.format(n % 1000),
+            'phone': '08-123 456 78',
+            'email': 'customer{}@example.com'.format(n % 1000),
+        },
+        'url': 'https://billogram.com/invoice/bg{:08d}'.format(n),
+    }
+
+
+def make_response(body, status_code=200, content_type='application/json'):
+    "Make a requests.Response as if received from the API"
+    resp = requests.models.Response()
+    resp.status_code = status_code
+    resp.headers['content-type'] = content_type
+    resp._content = body
+    return resp
+
+
+def best_time(func, number):
+    "Best average time per call of func, in seconds"
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def best_run(func, repeat=3):
+    "Best time of a single call of func, in seconds"
+    times = []
+    for n in range(repeat):
+        started = time.time()
+        func()
+        times.append(time.time() - started)
+    return min(times)
+
+
+def record(name, value, unit, higher_is_better=True):
+    "Print a result and remember it for saving and comparing"
+    RESULTS[name] = (value, higher_is_better)
+    print('    {:<36} {:10.1f} {}'.format(name, value, unit))
+
+
+def available_json_backends():
+    "The JSON decoders that can be passed to BillogramAPI as json_loads"
+    backends = [
+        ('json', lambda s: json.loads(s.decode('utf-8'))),
+    ]
+    for name in ('ujson', 'orjson'):
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        backends.append((name, module.loads))
+    return backends
+
+
+@benchmark
+def decode_page():
+    "Decoding of query result pages in _check_api_response"
+    for page_size in (100, 500):
+        body = json.dumps({
+            'status': 'OK',
+            'meta': {'total_count': 100000},
+            'data': [make_billogram(n) for n in range(page_size)],
+        }).encode('utf-8')
+        resp = make_response(body)
+        print('  page_size={} ({} kB)'.format(page_size, len(body) // 1024))
+        record(
+            'decode page_size={} Response.json()'.format(page_size),
+            best_time(resp.json, 20) * 1e6,
+            'us/page',
+            False
+        )
+        for name, loads in available_json_backends():
+            t = best_time(
+                lambda: billogram_api.BillogramAPI._check_api_response(
+                    resp,
+                    json_loads=loads
+                ),
+                20
+            )
+            record(
+                'decode page_size={} {}'.format(page_size, name),
+                t * 1e6,
+                'us/page',
+                False
+            )
+
+
+@benchmark
+def encode_billogram():
+    "Encoding of billogram creation payloads in BillogramAPI.post"
+    api = billogram_api.BillogramAPI('user', 'key')
+    for item_count in (10, 1000):
+        data = {
+            'customer': {'customer_no': 1},
+            'currency': 'SEK',
+            'due_date': '2013-05-31',
+            'items': [
+                {
+                    'title': 'Item {}'.format(n),
+                    'price': 99.5,
+                    'vat': 25,
+                    'unit': 'unit',
+                    'count': n,
+                } for n in range(item_count)
+            ],
+        }
+        record(
+            'encode {} items json.dumps'.format(item_count),
+            best_time(lambda: json.dumps(data), 20) * 1e6,
+            'us/call',
+            False
+        )
+        record(
+            'encode {} items _serialize'.format(item_count),
+            best_time(lambda: api._serialize(data), 20) * 1e6,
+            'us/call',
+            False
+        )
+
+
+@benchmark
+def conditional_refresh():
+    """Bytes transferred by repeated settings/logotype refreshes, also
+    checks that unchanged objects are not transferred again"""
+    stub = StandinServer()
+    transferred = {}
+    try:
+        for conditional in (False, True):
+            stub.reset_counters()
+            api = billogram_api.BillogramAPI(
+                'user',
+                'key',
+                api_base=stub.api_base,
+                conditional_get=conditional
+            )
+            t = best_time(
+                lambda: (api.settings.refresh(), api.logotype.refresh()),
+                50
+            )
+            transferred[conditional] = stub.body_bytes / stub.requests
+            label = 'refresh conditional_get={}'.format(conditional)
+            record(label, transferred[conditional], 'body bytes/refresh',
+                   False)
+            record(label + ' time', t * 1e6 / 2, 'us/refresh', False)
+            # a reused response must not carry changes made by a caller
+            name = api.settings['name']
+            api.settings.data['name'] = 'changed by caller'
+            api.settings.refresh()
+            if api.settings['name'] != name:
+                raise AssertionError('Remembered response data was shared')
+            api.close()
+        if transferred[True] * 10 > transferred[False]:
+            raise AssertionError(
+                'Conditional refreshes transferred {:.0f} of {:.0f} body '
+                'bytes'.format(transferred[True], transferred[False])
+            )
+    finally:
+        stub.close()
+
+
+@benchmark
+def iter_all():
+    "Objects per second iterated by Query.iter_all, 2 ms latency per request"
+    stub = StandinServer(billograms=3000, latency=0.002)
+    api = billogram_api.BillogramAPI(
+        'user',
+        'key',
+        api_base=stub.api_base,
+        conditional_get=False
+    )
+    try:
+        for label, options in (
+            ('sequential', {}),
+            ('prefetch=2', {'prefetch': 2}),
+            ('max_workers=4', {'max_workers': 4}),
+        ):
+            qry = api.billogram.query()
+            t = best_run(lambda: sum(1 for obj in qry.iter_all(**options)))
+            record('iter_all ' + label, 3000 / t, 'objects/s')
+    finally:
+        api.close()
+        stub.close()
+
+
+@benchmark
+def simpleclass_get():
+    "Time per SimpleClass.get of a billogram, without and with caching"
+    stub = StandinServer(billograms=200)
+    try:
+        ids = stub.ids('billogram')
+        for label, conditional, cache in (
+            ('plain', False, None),
+            ('conditional_get', True, None),
+            ('ObjectCache', False, billogram_api.ObjectCache()),
+        ):
+            api = billogram_api.BillogramAPI(
+                'user',
+                'key',
+                api_base=stub.api_base,
+                conditional_get=conditional
+            )
+            api.billogram.cache = cache
+            t = best_run(lambda: [api.billogram.get(i) for i in ids])
+            record('get ' + label, t / len(ids) * 1e6, 'us/get', False)
+            api.close()
+    finally:
+        stub.close()
+
+
+@benchmark
+def coalesced_get():
+    "Requests made by 50 threads getting the same customer, 20 ms latency"
+    import threading
+    stub = StandinServer(latency=0.02)
+    try:
+        for coalesce in (False, True):
+            api = billogram_api.BillogramAPI(
+                'user',
+                'key',
+                api_base=stub.api_base,
+                pool_maxsize=50,
+                coalesce_gets=coalesce
+            )
+            stub.reset_counters()
+            threads = [
+                threading.Thread(target=api.customers.get, args=(1,))
+                for n in range(50)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            record(
+                'get coalesce_gets={}'.format(coalesce),
+                stub.requests,
+                'requests',
+                False
+            )
+            api.close()
+    finally:
+        stub.close()
+
+
+@benchmark
+def shared_client():
+    """One client shared by 32 threads against one client per thread,
+    1 ms latency, also checks the shared client for errors"""
+    import random
+    import threading
+    stub = StandinServer(billograms=200, customers=50, latency=0.001)
+    ids = stub.ids('billogram')
+    threads_count = 32
+
+    def work(api, seen, errors):
+        rnd = random.Random()
+        try:
+            for n in range(30):
+                seen.add(id(api.billogram))
+                seen.add(id(api.settings))
+                op = rnd.randrange(4)
+                if op == 0:
+                    api.customers.get(rnd.randrange(1, 51))
+                elif op == 1:
+                    api.settings['name']
+                elif op == 2:
+                    qry = api.billogram.query().filter_state_any('Unpaid')
+                    assert qry.count == len(qry.get_page(1))
+                else:
+                    api.billogram.get(rnd.choice(ids)).send_message('x')
+        except Exception as e:
+            errors.append(e)
+
+    def run(shared):
+        stub.reset_counters()
+        seen = set()
+        errors = []
+        shared_api = billogram_api.BillogramAPI(
+            'user',
+            'key',
+            api_base=stub.api_base,
+            pool_maxsize=threads_count
+        )
+        apis = [
+            shared and shared_api or billogram_api.BillogramAPI(
+                'user',
+                'key',
+                api_base=stub.api_base
+            ) for n in range(threads_count)
+        ]
+        threads = [
+            threading.Thread(target=work, args=(api, seen, errors))
+            for api in apis
+        ]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        for api in set(apis):
+            api.close()
+        return threads_count * 30 / elapsed, seen, errors
+
+    try:
+        for shared in (False, True):
+            rate, seen, errors = run(shared)
+            label = shared and 'shared client' or 'client per thread'
+            record(label, rate, 'operations/s')
+            record(label + ' connections', stub.connections, 'connections',
+                   False)
+        if errors or len(seen) != 2:
+            raise AssertionError(
+                'Shared client failed: {!r}, {} collection objects'.format(
+                    errors[:3],
+                    len(seen)
+                )
+            )
+    finally:
+        stub.close()
+
+
+@benchmark
+def perform_event():
+    "Events per second performed on billograms, 2 ms latency per request"
+    stub = StandinServer(billograms=200, latency=0.002)
+    api = billogram_api.BillogramAPI('user', 'key', api_base=stub.api_base)
+    try:
+        ids = stub.ids('billogram')
+        bgs = [api.billogram.get(i) for i in ids]
+        event_data = {'message': 'Benchmark message'}
+        t = best_run(
+            lambda: [bg.perform_event('message', event_data) for bg in bgs],
+            1
+        )
+        record('perform_event sequential', len(ids) / t, 'events/s')
+        t = best_run(lambda: api.billogram.perform_events(
+            [(i, 'message', event_data) for i in ids],
+            max_workers=8
+        ), 1)
+        record('perform_events max_workers=8', len(ids) / t, 'events/s')
+    finally:
+        api.close()
+        stub.close()
+
+
+@benchmark
+def pdf_download():
+    "Throughput of invoice PDF downloads of 2 MB"
+    size = 2 * 1024 * 1024
+    stub = StandinServer(billograms=10, pdf_size=size)
+    api = billogram_api.BillogramAPI(
+        'user',
+        'key',
+        api_base=stub.api_base,
+        conditional_get=False
+    )
+    try:
+        bg = api.billogram.get(stub.ids('billogram')[0])
+        t = best_run(bg.get_invoice_pdf)
+        record('get_invoice_pdf', size / t / 1e6, 'MB/s')
+        t = best_run(lambda: bg.save_invoice_pdf(io.BytesIO()))
+        record('save_invoice_pdf', size / t / 1e6, 'MB/s')
+    finally:
+        api.close()
+        stub.close()
+
+
+@benchmark
+def replay_throughput():
+    "Client-side request rate replaying a recorded cassette without network"
+    import os
+    import tempfile
+    stub = StandinServer(billograms=500)
+    fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+    os.close(fd)
+    try:
+        api = billogram_api.BillogramAPI(
+            'user',
+            'key',
+            api_base=stub.api_base,
+            transport=billogram_api.RecordingTransport(path),
+            conditional_get=False
+        )
+        for bg in api.billogram.query().iter_all():
+            api.billogram.get(bg['id'])
+        api.close()
+        for max_workers in (1, 4):
+            api = billogram_api.BillogramAPI(
+                'user',
+                'key',
+                transport=billogram_api.ReplayTransport(path),
+                conditional_get=False
+            )
+            report = billogram_api.replay(path, api, None, max_workers)
+            record(
+                'replay max_workers={}'.format(max_workers),
+                report.requests_per_second,
+                'requests/s'
+            )
+    finally:
+        stub.close()
+        os.remove(path)
+
+
+def compare(baseline, tolerance):
+    "Compare RESULTS to saved results, returning the names that got worse"
+    worse = []
+    for name, (value, higher_is_better) in sorted(RESULTS.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name][0]
+        change = (value - old) / old
+        if not higher_is_better:
+            change = -change
+        print('{:<40} {:+7.1%}'.format(name, change))
+        if change < -tolerance:
+            worse.append(name)
+    return worse
+
+
+def main(prefixes):
+    for func in BENCHMARKS:
+        if prefixes and not any(func.__name__.startswith(p) for p in prefixes):
+            continue
+        print('{}: {}'.format(func.__name__, func.__doc__))
+        func()
+        print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run benchmarks')
+    parser.add_argument('prefixes', nargs='*')
+    parser.add_argument('--save', help='save results to this file')
+    parser.add_argument('--compare', help='compare results to this file')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    main(args.prefixes)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(RESULTS, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            worse = compare(json.load(f), args.tolerance)
+        if worse:
+            print('Worse than baseline: {}'.format(', '.join(worse)))
+            sys.exit(1)
@@ -24,12 +24,85 @@
 from __future__ import unicode_literals, print_function, division
 import requests
 import json
+import random
+import threading
+import time
+
+# immune to wall clock adjustments where available (Python 3.3+)
+_monotonic = getattr(time, 'monotonic', time.time)
 
 
 API_URL_BASE = "https://billogram.com/api/v2"
 USER_AGENT = "Billogram API Python Library/1.00"
 
 
+# marks the text of a Decimal no float can hold, see _exact_decimals, the
+# random part keeps ordinary strings from ever looking like one
+_EXACT_DECIMAL = '\x00decimal:{:016x}:'.format(
+    random.SystemRandom().getrandbits(64)
+)
+
+
+def _json_default(obj):
+    "Serialize the types commonly used for billogram data that JSON lacks"
+    import datetime
+    import decimal
+    if isinstance(obj, decimal.Decimal):
+        if not obj.is_finite():
+            raise ValueError('Cannot encode {!r} as JSON'.format(obj))
+        value = float(obj)
+        if decimal.Decimal(repr(value)) == obj:
+            return value
+        return _EXACT_DECIMAL + str(obj)
+    if isinstance(obj, (datetime.date, datetime.time)):
+        # also covers datetime.datetime, a subclass of date
+        return obj.isoformat()
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(
+            type(obj).__name__
+        )
+    )
+
+
+# use the fastest JSON decoder available, all of them accept utf-8 bytes
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _json_loads = ujson.loads
+    except ImportError:
+        def _json_loads(s):
+            return json.loads(s.decode('utf-8'))
+
+
+def _exact_decimals(encoded):
+    """Replace the marked strings _json_default made for Decimal values
+    that would be rounded as floats with the exact number text
+    """
+    import re
+    marker = b'"\\u0000' + _EXACT_DECIMAL[1:].encode('ascii')
+    if marker not in encoded:
+        return encoded
+    return re.sub(re.escape(marker) + b'([-+.0-9Ee]+)"', br'\1', encoded)
+
+
+# and the fastest encoder supporting _json_default, producing utf-8 bytes
+try:
+    import orjson
+
+    def _json_dumps(data):
+        return _exact_decimals(orjson.dumps(data, default=_json_default))
+except ImportError:
+    def _json_dumps(data):
+        return _exact_decimals(json.dumps(
+            data,
+            default=_json_default,
+            separators=(',', ':')
+        ).encode('utf-8'))
+
+
 # python 2/3 intercompatibility
 try:
     unicode  # not defined in py3k
@@ -45,6 +118,33 @@ except NameError:
         return s
 
 
+def _iter_concurrent(func, items, max_workers, window=None):
+    """Call func on every element of items using a pool of worker threads
+
+    Results are yielded in the same order as items. At most 'window' calls
+    (by default twice the number of workers) are in flight or waiting to be
+    consumed at any time, which keeps memory use bounded. Closing the
+    generator early cancels calls that have not started yet.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import collections
+
+    window = max(int(window or 2 * max_workers), 1)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = collections.deque()
+    try:
+        for item in items:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
 class BillogramAPIError(Exception):
     "Base class for errors from the Billogram API"
     def __init__(self, message, **kwargs):
@@ -132,19 +232,1055 @@ class ObjectNotAvailableYetError(ObjectNotFoundError):
     pass
 
 
+class RateLimitExceededError(BillogramAPIError):
+    "Too many requests were made, the request should be retried later"
+    pass
+
+
+class _BufferedResponse(object):
+    """Response with an already read body, for transports other than requests
+
+    Provides the subset of the requests.Response interface used by
+    BillogramAPI. Header names must be lowercase.
+    """
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class BulkResult(object):
+    """Outcome of a single operation in a bulk call
+
+    'item' is the input the operation was performed for, 'result' is the
+    returned object when it succeeded and 'exception' is the raised exception
+    when it failed.
+    """
+    __slots__ = ('item', 'result', 'exception')
+
+    def __init__(self, item, result=None, exception=None):
+        self.item = item
+        self.result = result
+        self.exception = exception
+
+    @property
+    def ok(self):
+        "True if the operation succeeded"
+        return self.exception is None
+
+    def __repr__(self):
+        return _printable_repr(
+            '<BulkResult {!r}: {}>'.format(
+                self.item,
+                self.ok and 'ok' or repr(self.exception)
+            )
+        )
+
+
+class ArchiveReport(object):
+    """Progress and outcome of an invoice PDF archiving run
+
+    Counts the PDFs saved and skipped, the number of bytes saved and the
+    time taken, and holds a BulkResult for each billogram that failed.
+    """
+    def __init__(self):
+        self.saved = 0
+        self.skipped = 0
+        self.failed = []
+        self.bytes = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    @property
+    def mb_per_second(self):
+        "Download throughput in megabytes of PDF per second"
+        return self.elapsed and self.bytes / 1e6 / self.elapsed or 0.0
+
+    @property
+    def pdfs_per_second(self):
+        "Download throughput in PDFs per second"
+        return self.elapsed and self.saved / self.elapsed or 0.0
+
+    def __repr__(self):
+        return _printable_repr(
+            '<ArchiveReport {} saved, {} skipped, {} failed, '
+            '{:.2f} MB/s, {:.1f} PDFs/s>'.format(
+                self.saved,
+                self.skipped,
+                len(self.failed),
+                self.mb_per_second,
+                self.pdfs_per_second
+            )
+        )
+
+
+class ReplayReport(object):
+    """Outcome of replaying a cassette, see replay
+
+    Counts the requests made and the errors by exception class name, and
+    keeps the duration of every request. 'max_lag' is the longest time a
+    request was started after it was due, a growing lag means the client
+    could not keep up with the replay speed.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.errors = {}
+        self.durations = []
+        self.max_lag = 0.0
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    @property
+    def requests_per_second(self):
+        "Request rate achieved over the whole replay"
+        return self.elapsed and self.requests / self.elapsed or 0.0
+
+    def percentile(self, p):
+        "Request duration at percentile p, from 0 to 100"
+        if not self.durations:
+            return 0.0
+        durations = sorted(self.durations)
+        return durations[min(
+            int(len(durations) * p / 100),
+            len(durations) - 1
+        )]
+
+    def __repr__(self):
+        return _printable_repr(
+            '<ReplayReport {} requests, {} errors, {:.1f} requests/s, '
+            'p50 {:.1f} ms, p99 {:.1f} ms, max lag {:.1f} ms>'.format(
+                self.requests,
+                sum(self.errors.values()),
+                self.requests_per_second,
+                self.percentile(50) * 1e3,
+                self.percentile(99) * 1e3,
+                self.max_lag * 1e3
+            )
+        )
+
+
+class RetryPolicy(object):
+    """Rules for automatically retrying failed requests
+
+    Requests failing with a server error, a rate limit response or a
+    connection error are retried up to max_retries times. The wait before
+    each retry grows exponentially from backoff_factor seconds up to at most
+    max_backoff seconds, with random jitter applied. A Retry-After header
+    sent by the server is always honoured.
+
+    Only idempotent requests (GET, PUT and DELETE) are retried, unless
+    retry_post is set. POST requests are always retried if the connection
+    could not be established at all, since the request was then never sent.
+
+    Setting poll_timeout makes GET requests for objects that are not
+    available yet (ObjectNotAvailableYetError) be repeated every
+    poll_interval seconds until the object appears or poll_timeout seconds
+    have passed.
+    """
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE'])
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30,
+                 jitter=True, retry_post=False, poll_timeout=0,
+                 poll_interval=1):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_post = retry_post
+        self.poll_timeout = poll_timeout
+        self.poll_interval = poll_interval
+
+    def is_retryable(self, method, exception):
+        "Determine if a request failing with exception may be retried"
+        if isinstance(exception, requests.exceptions.ConnectTimeout):
+            # the request never reached the server
+            return True
+        if method not in self.IDEMPOTENT_METHODS and not self.retry_post:
+            return False
+        return isinstance(exception, (
+            ServiceMalfunctioningError,
+            RateLimitExceededError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ))
+
+    def backoff(self, attempt):
+        "Seconds to wait before the retry following the zero-based attempt"
+        delay = min(self.backoff_factor * (2 ** attempt), self.max_backoff)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def get_delay(self, method, exception, attempt, elapsed,
+                  retry_after=None):
+        """Seconds to wait before retrying a failed request, or None if the
+        request should not be retried"""
+        if isinstance(exception, ObjectNotAvailableYetError):
+            if method == 'GET' and \
+                    elapsed + self.poll_interval <= self.poll_timeout:
+                return self.poll_interval
+            return None
+        if attempt >= self.max_retries or \
+                not self.is_retryable(method, exception):
+            return None
+        delay = self.backoff(attempt)
+        retry_after = _parse_retry_after(retry_after)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+def _parse_retry_after(value):
+    "Parse a Retry-After header value into a number of seconds"
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    import email.utils
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(email.utils.mktime_tz(parsed) - time.time(), 0)
+
+
+class RateLimiter(object):
+    """Client-side token bucket limiting the rate of requests
+
+    Allows on average 'rate' requests per second, with bursts of up to
+    'burst' requests. Safe to share between threads and between several
+    BillogramAPI objects using the same API account.
+    """
+    def __init__(self, rate, burst=None):
+        assert rate > 0
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self._tokens = self.burst
+        self._updated = _monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        "Take a token from the bucket, blocking until one is available"
+        while True:
+            with self._lock:
+                now = _monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class _SingleFlight(object):
+    """Lets concurrent calls with the same key share a single execution
+
+    The first caller for a key runs the function, callers arriving while
+    it runs wait for it and get the same result or exception.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def call(self, key, func):
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = [threading.Event(), None, None]
+        if not leader:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+        try:
+            flight[1] = func()
+            return flight[1]
+        except BaseException as e:
+            flight[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            flight[0].set()
+
+
+class ObjectCache(object):
+    """Size limited LRU cache with optional expiry of entries
+
+    Holds at most maxsize entries, evicting the least recently used entry
+    when full. Entries older than ttl seconds are treated as missing, pass
+    None in ttl to keep entries until evicted. The number of cache hits and
+    misses are counted in the hits and misses attributes.
+
+    Safe to share between threads.
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        assert maxsize >= 1
+        import collections
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        "Return the value cached for key, or None if there is none"
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl is not None and \
+                    entry[0] + self.ttl < _monotonic():
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # reinsert to mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        "Cache value for key"
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (_monotonic(), value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        "Remove any value cached for key"
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        "Remove all cached values"
+        with self._lock:
+            self._entries.clear()
+
+
+class RequestMetrics(object):
+    """Measurements of one call to the Billogram API, reported to hooks
+
+    'phases' maps phase names to seconds spent in them, summed over all
+    attempts:
+     - wait: throttled by the rate limiter or waiting before a retry
+     - response: from sending the request until the response headers are
+       received, this includes DNS lookup, connecting and TLS handshake when
+       a new connection is opened, and the server processing time
+     - read: reading the response body
+     - decode: decoding the JSON body and checking it for errors
+    The byte counts are of request and response bodies as transferred.
+    'status' is the status code of the last response, and 'exception' the
+    exception the call raised, None if there was none.
+    """
+    __slots__ = (
+        'method', 'obj', 'started', 'elapsed', 'attempts', 'status',
+        'exception', 'request_bytes', 'response_bytes', 'phases'
+    )
+
+    def __init__(self, method, obj, started):
+        self.method = method
+        self.obj = obj
+        self.started = started
+        self.elapsed = None
+        self.attempts = 0
+        self.status = None
+        self.exception = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.phases = {}
+
+    @property
+    def endpoint(self):
+        """The object path with the object id replaced by a placeholder,
+        e.g. 'billogram/{id}/command/send'"""
+        parts = self.obj.split('/')
+        if len(parts) > 1:
+            name, dot, extension = parts[1].partition('.')
+            parts[1] = '{id}' + dot + extension
+        return '/'.join(parts)
+
+    def lap(self, phase, mark):
+        "Add the time since mark to a phase, returning the current time"
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0) + now - mark
+        return now
+
+    def __repr__(self):
+        return '<RequestMetrics {} {} status={} elapsed={:.3f}>'.format(
+            self.method,
+            self.obj,
+            self.status,
+            self.elapsed or 0
+        )
+
+
+class RequestHook(object):
+    """Base class for instrumentation hooks, see BillogramAPI
+
+    Override the methods for the events of interest. Hooks are called from
+    the thread making the request and should return quickly, exceptions
+    they raise are not caught.
+    """
+    def request_finished(self, metrics):
+        "Called with a RequestMetrics after every call to the API"
+        pass
+
+    def objects_built(self, type_name, count, seconds):
+        """Called after the objects of a query page are built, with the
+        object type, number of objects and time taken"""
+        pass
+
+
+class PrometheusHook(RequestHook):
+    """Hook recording Prometheus metrics, requires the prometheus_client
+    package
+
+    Records these metrics, labelled by method and endpoint:
+     - <prefix>_requests_total, also labelled by status code
+     - <prefix>_errors_total, also labelled by exception class
+     - <prefix>_request_duration_seconds
+     - <prefix>_request_phase_seconds, also labelled by phase
+     - <prefix>_request_bytes_total and <prefix>_response_bytes_total
+    and <prefix>_objects_built_seconds labelled by object type.
+    Metrics are registered in the default registry unless another is given.
+    """
+    def __init__(self, registry=None, prefix='billogram_api'):
+        import prometheus_client
+        options = {}
+        if registry is not None:
+            options['registry'] = registry
+        labels = ('method', 'endpoint')
+        self.requests = prometheus_client.Counter(
+            prefix + '_requests_total',
+            'Requests made to the Billogram API',
+            labels + ('status',),
+            **options
+        )
+        self.errors = prometheus_client.Counter(
+            prefix + '_errors_total',
+            'Billogram API calls that raised an exception',
+            labels + ('exception',),
+            **options
+        )
+        self.duration = prometheus_client.Histogram(
+            prefix + '_request_duration_seconds',
+            'Duration of Billogram API calls, including retries',
+            labels,
+            **options
+        )
+        self.phases = prometheus_client.Histogram(
+            prefix + '_request_phase_seconds',
+            'Time spent in each phase of Billogram API calls',
+            labels + ('phase',),
+            **options
+        )
+        self.request_bytes = prometheus_client.Counter(
+            prefix + '_request_bytes_total',
+            'Bytes of request bodies sent to the Billogram API',
+            labels,
+            **options
+        )
+        self.response_bytes = prometheus_client.Counter(
+            prefix + '_response_bytes_total',
+            'Bytes of response bodies received from the Billogram API',
+            labels,
+            **options
+        )
+        self.objects = prometheus_client.Histogram(
+            prefix + '_objects_built_seconds',
+            'Time spent building objects from query pages',
+            ('type',),
+            **options
+        )
+
+    def request_finished(self, metrics):
+        labels = (metrics.method, metrics.endpoint)
+        self.requests.labels(
+            *labels + ('{}'.format(metrics.status or ''),)
+        ).inc()
+        if metrics.exception is not None:
+            self.errors.labels(
+                *labels + (type(metrics.exception).__name__,)
+            ).inc()
+        self.duration.labels(*labels).observe(metrics.elapsed)
+        for phase, seconds in metrics.phases.items():
+            self.phases.labels(*labels + (phase,)).observe(seconds)
+        self.request_bytes.labels(*labels).inc(metrics.request_bytes)
+        self.response_bytes.labels(*labels).inc(metrics.response_bytes)
+
+    def objects_built(self, type_name, count, seconds):
+        self.objects.labels(type_name).observe(seconds)
+
+
+class OpenTelemetryHook(RequestHook):
+    """Hook recording a span for every API call, requires the
+    opentelemetry-api package
+
+    Spans are created when calls finish, with the start and end times of
+    the call, as children of the span current in the calling thread. Phase
+    timings and byte counts are added as attributes.
+    """
+    def __init__(self, tracer=None):
+        from opentelemetry import trace
+        self._trace = trace
+        self._tracer = tracer or trace.get_tracer('billogram_api')
+
+    def request_finished(self, metrics):
+        trace = self._trace
+        attributes = {
+            'http.request.method': metrics.method,
+            'billogram.object': metrics.obj,
+            'billogram.attempts': metrics.attempts,
+            'billogram.request_bytes': metrics.request_bytes,
+            'billogram.response_bytes': metrics.response_bytes,
+        }
+        if metrics.status is not None:
+            attributes['http.response.status_code'] = metrics.status
+        for phase, seconds in metrics.phases.items():
+            attributes['billogram.phase.{}'.format(phase)] = seconds
+        span = self._tracer.start_span(
+            '{} {}'.format(metrics.method, metrics.endpoint),
+            kind=trace.SpanKind.CLIENT,
+            attributes=attributes,
+            start_time=int(metrics.started * 1e9)
+        )
+        if metrics.exception is not None:
+            span.record_exception(metrics.exception)
+            span.set_status(trace.Status(
+                trace.StatusCode.ERROR,
+                type(metrics.exception).__name__
+            ))
+        span.end(end_time=int((metrics.started + metrics.elapsed) * 1e9))
+
+
+class _Base64FieldDecoder(object):
+    """Incrementally extract and decode a base64 string field from JSON
+
+    Feed the raw bytes of a JSON document in chunks. The value of the first
+    string field named 'field' is base64 decoded and written to out as it
+    arrives, only a few bytes of it are buffered at any time. The rest of the
+    document is kept so it can be parsed once complete, with the field value
+    replaced by an empty string.
+    """
+    def __init__(self, field, out):
+        import re
+        self._field_re = re.compile(
+            br'(?<!\\)"' + field.encode('utf-8') + br'"\s*:\s*"'
+        )
+        self._out = out
+        self._state = 'before'
+        self._head = b''
+        self._tail = b''
+        self._pending = b''
+        self.written = 0
+
+    def feed(self, chunk):
+        if self._state == 'before':
+            # look for the field, allowing for it being split between chunks
+            pos = max(len(self._head) - 64, 0)
+            self._head += chunk
+            match = self._field_re.search(self._head, pos)
+            if match is None:
+                return
+            chunk = self._head[match.end():]
+            self._head = self._head[:match.end()]
+            self._state = 'field'
+        if self._state == 'field':
+            # base64 never contains quotes, so the first one ends the value
+            end = chunk.find(b'"')
+            if end < 0:
+                self._decode(chunk, final=False)
+                return
+            self._decode(chunk[:end], final=True)
+            self._state = 'after'
+            chunk = chunk[end:]
+        self._tail += chunk
+
+    def _decode(self, data, final):
+        import base64
+        data = self._pending + data
+        escape = b''
+        if data.endswith(b'\\') and not final:
+            # escape sequence split between chunks
+            data, escape = data[:-1], b'\\'
+        # the only JSON escapes expected in base64 data
+        data = data.replace(b'\\/', b'/')
+        data = data.replace(b'\\n', b'').replace(b'\\r', b'')
+        usable = final and len(data) or len(data) - len(data) % 4
+        self._pending = data[usable:] + escape
+        if not usable:
+            return
+        try:
+            decoded = base64.b64decode(data[:usable])
+        except (TypeError, ValueError):
+            raise ServiceMalfunctioningError(
+                'Billogram API returned invalid base64 content'
+            )
+        self._out.write(decoded)
+        self.written += len(decoded)
+
+    def finish(self):
+        """Return the rest of the document with an empty field value, or
+        the whole document if the field was not found"""
+        if self._state == 'field':
+            raise ServiceMalfunctioningError(
+                'Billogram API response was truncated'
+            )
+        return self._head + self._tail
+
+
+class _Base64JSONBody(object):
+    """Streaming JSON request body with a base64 encoded binary field
+
+    Produces the JSON encoding of 'fields' with 'field' added, holding the
+    base64 encoding of 'source'. The source is either a bytes-like object,
+    or a binary file object such as an open file or an mmap. The body is
+    produced in small chunks, either by iteration or by the read method, so
+    the source is never encoded as a whole.
+
+    'size' is the number of bytes of source data, when known it is used to
+    provide the total length of the body in the len attribute. The sent
+    attribute counts the bytes produced since the last rewind. 'offset' is
+    where the data starts in the source, by default the current position of
+    a file object or the start of a bytes-like object.
+    """
+    chunk_size = 3 * 16 * 1024
+
+    def __init__(self, fields, field, source, size=None, offset=None):
+        head = json.dumps(fields, separators=(',', ':'))[:-1]
+        if fields:
+            head += ','
+        head += json.dumps(field) + ':"'
+        self._head = head.encode('utf-8')
+        self._tail = b'"}'
+        self._source = source
+        self._seekable = hasattr(source, 'read') and \
+            hasattr(source, 'seek') and \
+            (not hasattr(source, 'seekable') or source.seekable())
+        if offset is None:
+            offset = self._seekable and source.tell() or 0
+        self._start = offset
+        if size is not None:
+            self.len = len(self._head) + (size + 2) // 3 * 4 + len(self._tail)
+        self._chunks = None
+        self.rewind()
+
+    def rewind(self):
+        "Restart the body from the beginning"
+        if hasattr(self._source, 'read'):
+            if self._seekable:
+                self._source.seek(self._start)
+            elif self._chunks is not None:
+                raise BillogramAPIError('Request body can not be sent again')
+        self._position = self._start
+        self._chunks = self._generate()
+        self._buffer = b''
+        self.sent = 0
+
+    def _read_source(self, size):
+        if hasattr(self._source, 'read'):
+            return self._source.read(size)
+        data = bytes(self._source[self._position:self._position + size])
+        self._position += len(data)
+        return data
+
+    def _generate(self):
+        for chunk in self._encode():
+            self.sent += len(chunk)
+            yield chunk
+
+    def _encode(self):
+        import base64
+        yield self._head
+        leftover = b''
+        while True:
+            raw = self._read_source(self.chunk_size)
+            if not raw:
+                break
+            raw = leftover + raw
+            # only encode whole three byte groups until the end
+            usable = len(raw) - len(raw) % 3
+            leftover = raw[usable:]
+            if usable:
+                yield base64.b64encode(raw[:usable])
+        if leftover:
+            yield base64.b64encode(leftover)
+        yield self._tail
+
+    def __iter__(self):
+        if self._buffer:
+            yield self._buffer
+            self._buffer = b''
+        for chunk in self._chunks:
+            yield chunk
+
+    def read(self, size=-1):
+        "Read up to size bytes of the body, or all remaining bytes"
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _sent_bytes(data):
+    "Number of bytes of a request body handed to the transport"
+    if isinstance(data, _Base64JSONBody):
+        # the size of a body streamed from a pipe is only known afterwards
+        return data.sent
+    return len(data)
+
+
+def _streamed_bytes(resp):
+    "Number of body bytes read from a streamed response"
+    tell = getattr(getattr(resp, 'raw', None), 'tell', None)
+    if tell is not None:
+        return tell()
+    return len(resp.content)
+
+
+class Transport(object):
+    """Base class for transports, which send the HTTP requests of a
+    BillogramAPI
+
+    A transport implements request, returning a requests.Response or an
+    object with the same status_code, ok, headers, content, iter_content
+    and close members. When stream is set the body should not be read up
+    front. 'data' is None, a bytes object, or an iterable of bytes objects
+    with the total length in its len attribute.
+    """
+    def request(self, method, url, auth=None, params=None, data=None,
+                headers=None, stream=False):
+        raise NotImplementedError()
+
+    def close(self):
+        "Release any resources held by the transport"
+        pass
+
+
+class RequestsTransport(Transport):
+    """Transport sending requests on a pooled requests.Session
+
+    This is the default transport, see BillogramAPI for the parameters. A
+    session passed in is used as-is and not closed by close.
+    """
+    def __init__(self, session=None, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, keep_alive=True):
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self._keep_alive = keep_alive
+        self._session = session
+
+    def request(self, method, url, auth=None, params=None, data=None,
+                headers=None, stream=False):
+        if not self._keep_alive:
+            # per request, so a session passed in is left unchanged
+            headers = dict(headers or {}, connection='close')
+        return self._session.request(
+            method,
+            url,
+            auth=auth,
+            params=params,
+            data=data,
+            headers=headers,
+            stream=stream
+        )
+
+    def close(self):
+        if self._owns_session:
+            self._session.close()
+
+
+# response headers kept in cassettes
+_CASSETTE_HEADERS = ('content-type', 'etag', 'last-modified', 'retry-after')
+
+
+def _cassette_encode(entry, key, content):
+    "Store a body in a cassette entry, decoded if it is JSON"
+    if not content:
+        return
+    try:
+        entry[key] = json.loads(content.decode('utf-8'))
+    except ValueError:
+        import base64
+        entry[key + 'x'] = base64.b64encode(content).decode('ascii')
+
+
+def _cassette_decode(entry, key):
+    "Body stored in a cassette entry, as bytes"
+    if key in entry:
+        return _json_dumps(entry[key])
+    if key + 'x' in entry:
+        import base64
+        return base64.b64decode(entry[key + 'x'])
+    return b''
+
+
+def _read_cassette(path):
+    "Iterate over the entries of a cassette file, compressed or not"
+    import gzip
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    f = compressed and gzip.open(path, 'rb') or open(path, 'rb')
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+    finally:
+        f.close()
+
+
+class RecordingTransport(Transport):
+    """Transport recording every request and response to a cassette file
+
+    Requests are sent by another transport, by default a new
+    RequestsTransport. Each exchange is written as one line of JSON with
+    the time it was sent, its duration, the method, URL path, query
+    parameters and bodies. JSON bodies are stored decoded and other bodies
+    base64 encoded. Authentication and request headers are not recorded.
+
+    The cassette is gzip compressed if compress is set, by default when the
+    path ends in '.gz'. Request bodies streamed from files are read into
+    memory while recording. Call close to finish the cassette.
+    """
+    def __init__(self, path, transport=None, compress=None):
+        import gzip
+        if compress is None:
+            compress = path.endswith('.gz')
+        self._file = compress and gzip.open(path, 'wb') or open(path, 'wb')
+        self._transport = transport or RequestsTransport()
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    def request(self, method, url, auth=None, params=None, data=None,
+                headers=None, stream=False):
+        try:
+            from urllib.parse import urlsplit
+        except ImportError:
+            from urlparse import urlsplit
+        if hasattr(data, 'rewind'):
+            data = b''.join(data)
+        sent = time.time()
+        resp = self._transport.request(
+            method,
+            url,
+            auth=auth,
+            params=params,
+            data=data,
+            headers=headers,
+            stream=stream
+        )
+        try:
+            content = resp.content
+        finally:
+            resp.close()
+        entry = {
+            't': round(sent - self._started, 6),
+            'd': round(time.time() - sent, 6),
+            'm': method,
+            'p': urlsplit(url).path,
+            's': resp.status_code,
+            'h': dict(
+                (name, resp.headers[name])
+                for name in _CASSETTE_HEADERS if resp.headers.get(name)
+            ),
+        }
+        if params:
+            entry['q'] = params
+        _cassette_encode(entry, 'b', data)
+        _cassette_encode(entry, 'c', content)
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line.encode('utf-8'))
+        return _BufferedResponse(resp.status_code, entry['h'], content)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        self._transport.close()
+
+
+def _cassette_key(method, path, params, body):
+    return (
+        method,
+        path,
+        json.dumps(params or {}, sort_keys=True),
+        None if body is None else json.dumps(body, sort_keys=True)
+    )
+
+
+class ReplayTransport(Transport):
+    """Transport answering requests with the responses in a cassette
+
+    Requests are matched to recorded ones by method, URL path, query
+    parameters and body, the host is ignored. Repeated identical requests
+    get the recorded responses in order, the last one is reused when they
+    run out. Requests that were not recorded raise BillogramAPIError.
+
+    With speed set, every response is delayed by its recorded duration
+    divided by speed, otherwise responses are immediate.
+    """
+    def __init__(self, path, speed=None):
+        import collections
+        self.speed = speed
+        self._responses = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        for entry in _read_cassette(path):
+            key = _cassette_key(
+                entry['m'],
+                entry['p'],
+                entry.get('q'),
+                entry.get('b')
+            )
+            self._responses[key].append(entry)
+
+    def request(self, method, url, auth=None, params=None, data=None,
+                headers=None, stream=False):
+        try:
+            from urllib.parse import urlsplit
+        except ImportError:
+            from urlparse import urlsplit
+        if hasattr(data, 'rewind'):
+            data = b''.join(data)
+        body = json.loads(data.decode('utf-8')) if data else None
+        path = urlsplit(url).path
+        # parameters are compared in the form they are recorded in
+        params = params and json.loads(json.dumps(params))
+        with self._lock:
+            entries = self._responses.get(
+                _cassette_key(method, path, params, body)
+            )
+            if not entries:
+                raise BillogramAPIError(
+                    'No recorded response for {} {}'.format(method, path)
+                )
+            entry = len(entries) > 1 and entries.popleft() or entries[0]
+        if self.speed:
+            time.sleep(entry['d'] / self.speed)
+        return _BufferedResponse(
+            entry['s'],
+            entry['h'],
+            _cassette_decode(entry, 'c')
+        )
+
+
 class BillogramAPI(object):
     """Pseudo-connection to the Billogram v2 API
 
     Objects of this class provide a call interface to the Billogram
     v2 HTTP API.
+
+    One object can be shared by any number of threads, which then share its
+    connection pool; set pool_maxsize to the number of threads making
+    requests at once. The collection objects are created once, on first
+    use. Objects returned by the API replace their data in one step when
+    refreshed or updated, so other threads see either the old or the new
+    data, never a mix, and a Query remembers its count likewise. Query
+    objects should not be modified while used from other threads, but
+    iter_all works on a copy. Concurrent GET requests for the same object
+    are coalesced, see coalesce_gets.
     """
-    def __init__(self, auth_user, auth_key, user_agent=None, api_base=None):
+    def __init__(self, auth_user, auth_key, user_agent=None, api_base=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True, session=None, retry=None,
+                 rate_limit=None, json_loads=None, json_dumps=None,
+                 conditional_get=True, hooks=None, transport=None,
+                 coalesce_gets=True):
         """Create a Billogram API connection object
 
         Pass the API authentication in the auth_user and auth_key parameters.
         API accounts can only be created from the Billogram web interface.
+
+        All requests made through the object share one HTTP session, so TCP
+        and TLS connections are reused between calls. The connection pool can
+        be tuned with these parameters:
+         - pool_connections: number of distinct hosts to keep pools for
+         - pool_maxsize: max number of connections kept open per host
+         - pool_block: block when all connections to a host are busy instead
+           of opening extra, non-pooled connections
+         - keep_alive: set to False to close connections after every request
+
+        An existing requests.Session can be passed in the session parameter,
+        it is then used as-is and is not closed by the close method.
+
+        Requests are sent by a RequestsTransport using the session and pool
+        parameters. Pass another Transport object in transport to send them
+        some other way, e.g. a RecordingTransport or ReplayTransport, the
+        session and pool parameters are then not used.
+
+        Pass a RetryPolicy object in retry to have failed requests retried
+        automatically. Pass a RateLimiter object, or a number of requests per
+        second, in rate_limit to keep the request rate below the API quota.
+
+        Response bodies are decoded with orjson or ujson when installed, and
+        the standard json module otherwise. Pass a function taking utf-8
+        encoded bytes in json_loads to use a different decoder.
+
+        Request data is likewise encoded with orjson when installed. Decimal,
+        date, time and datetime values in request data are handled natively,
+        as numbers and ISO 8601 strings. Decimal numbers are sent exactly,
+        also when a float could not hold them. Pass a function returning utf-8
+        encoded bytes in json_dumps to use a different encoder.
+
+        When the API sends ETag or Last-Modified validators for the GET
+        response of a single object, the response is remembered and later
+        GET requests for the same object are made conditional. If the object
+        has not changed the remembered response is reused without
+        transferring the body again. Query pages and PDF downloads are not
+        remembered. Pass a number in conditional_get to set how many
+        responses are remembered (100 by default), or False to disable this.
+
+        Concurrent GET requests for the same object and parameters, e.g.
+        from several threads of a web server, share one request to the API
+        and all get its result, or its exception. The decoded response data
+        is then shared too, so it should not be modified in place. A GET
+        made after a POST, PUT or DELETE request has completed never shares
+        a request started before it. Set coalesce_gets to False to always
+        make separate requests.
+
+        Pass a list of RequestHook objects in hooks to have every request
+        measured and reported to them, see RequestHook. The list is kept in
+        the hooks attribute and may be changed later. Without hooks no
+        measurements are made.
+
+        The object can be used as a context manager, the connection pool is
+        closed on exit.
         """
         self._auth = (auth_user, auth_key)
+        self._lock = threading.Lock()
         self._items = None
         self._customers = None
         self._billogram = None
@@ -153,60 +1289,127 @@ class BillogramAPI(object):
         self._reports = None
         self._user_agent = user_agent or USER_AGENT
         self._api_base = api_base or API_URL_BASE
+        if transport is None:
+            transport = RequestsTransport(
+                session,
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+                keep_alive=keep_alive
+            )
+        self._transport = transport
+        self._retry = retry
+        if rate_limit is not None and not isinstance(rate_limit, RateLimiter):
+            rate_limit = RateLimiter(rate_limit)
+        self._rate_limiter = rate_limit
+        self._json_loads = json_loads or _json_loads
+        self._json_dumps = json_dumps or _json_dumps
+        self._validators = None
+        if conditional_get:
+            self._validators = ObjectCache(
+                maxsize=100 if conditional_get is True else conditional_get
+            )
+        self.hooks = list(hooks or ())
+        self._in_flight = None
+        if coalesce_gets:
+            self._in_flight = _SingleFlight()
+        # counts completed writes, so reads can tell which flights are stale
+        self._write_generation = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        "Close all pooled connections held by this object"
+        self._transport.close()
 
     @property
     def items(self):
         "Provide access to the items database"
         if self._items is None:
-            self._items = SimpleClass(self, 'item', 'item_no')
+            with self._lock:
+                if self._items is None:
+                    self._items = SimpleClass(self, 'item', 'item_no')
         return self._items
 
     @property
     def customers(self):
         "Provide access to the customer database"
         if self._customers is None:
-            self._customers = SimpleClass(self, 'customer', 'customer_no')
+            with self._lock:
+                if self._customers is None:
+                    self._customers = SimpleClass(
+                        self,
+                        'customer',
+                        'customer_no'
+                    )
         return self._customers
 
     @property
     def billogram(self):
         "Provide access to billogram objects and attached invoices"
         if self._billogram is None:
-            self._billogram = BillogramClass(self)
+            with self._lock:
+                if self._billogram is None:
+                    self._billogram = BillogramClass(self)
         return self._billogram
 
     @property
     def settings(self):
         "Provide access to settings for the Billogram account"
         if self._settings is None:
-            self._settings = SingletonObject(self, 'settings')
+            with self._lock:
+                if self._settings is None:
+                    self._settings = SingletonObject(self, 'settings')
         return self._settings
 
     @property
     def logotype(self):
         "Provide access to the logotype for the Billogram account"
         if self._logotype is None:
-            self._logotype = SingletonObject(self, 'logotype')
+            with self._lock:
+                if self._logotype is None:
+                    self._logotype = SingletonObject(self, 'logotype')
         return self._logotype
 
     @property
     def reports(self):
         "Provide access to the reports database"
         if self._reports is None:
-            self._reports = SimpleClass(self, 'report', 'filename')
+            with self._lock:
+                if self._reports is None:
+                    self._reports = SimpleClass(self, 'report', 'filename')
         return self._reports
 
     @classmethod
-    def _check_api_response(cls, resp, expect_content_type=None):
+    def _check_api_response(cls, resp, expect_content_type=None,
+                            json_loads=None):
+        """Check a response for errors and return its data
+
+        Raises the BillogramAPIError subclass matching the error reported by
+        the API. This is shared by all clients, resp only needs to provide
+        the status_code, ok, headers and content members of a
+        requests.Response. The body is decoded at most once, with json_loads
+        or the fastest JSON decoder available.
+        """
+        json_loads = json_loads or _json_loads
         if not resp.ok or expect_content_type is None:
             # if the request failed the response should always be json
             expect_content_type = 'application/json'
+        content_type = resp.headers.get('content-type')
+        is_json = content_type == 'application/json'
+
+        if resp.status_code == 429:
+            # throttled, the body may not be an API response at all
+            raise RateLimitExceededError('Too many requests')
 
-        if resp.status_code in range(500, 600):
+        if 500 <= resp.status_code < 600:
             # internal error
-            if resp.headers['content-type'] == expect_content_type and \
-                    expect_content_type == 'application/json':
-                data = resp.json()
+            if is_json:
+                data = json_loads(resp.content)
                 raise ServiceMalfunctioningError(
                     'Billogram API reported a server error: {} - {}'.format(
                         data.get('status'),
@@ -218,11 +1421,11 @@ class BillogramAPI(object):
                 'Billogram API reported a server error'
             )
 
-        if resp.headers['content-type'] != expect_content_type:
+        if content_type != expect_content_type:
             # the service returned a different content-type from the expected,
             # probably some malfunction on the remote end
-            if resp.headers['content-type'] == 'application/json':
-                data = resp.json()
+            if is_json:
+                data = json_loads(resp.content)
                 if data.get('status') == 'NOT_AVAILABLE_YET':
                     raise ObjectNotAvailableYetError(
                         'Object not available yet'
@@ -231,21 +1434,21 @@ class BillogramAPI(object):
                 'Billogram API returned unexpected content type'
             )
 
-        if expect_content_type == 'application/json':
-            data = resp.json()
-            status = data.get('status')
-            if not status:
-                raise ServiceMalfunctioningError(
-                    'Response data missing status field'
-                )
-            if not 'data' in data:
-                raise ServiceMalfunctioningError(
-                    'Response data missing data field'
-                )
-        else:
+        if not is_json:
             # per above, non-json responses are always ok, so just return them
             return resp.content
 
+        data = json_loads(resp.content)
+        status = data.get('status')
+        if not status:
+            raise ServiceMalfunctioningError(
+                'Response data missing status field'
+            )
+        if not 'data' in data:
+            raise ServiceMalfunctioningError(
+                'Response data missing data field'
+            )
+
         if resp.status_code == 403:
             # bad auth
             if status == 'PERMISSION_DENIED':
@@ -268,8 +1471,8 @@ class BillogramAPI(object):
 
         if resp.status_code == 404:
             # not found
-            if data.get('status') == 'NOT_AVAILABLE_YET':
-                raise ObjectNotFoundError('Object not available yet')
+            if status == 'NOT_AVAILABLE_YET':
+                raise ObjectNotAvailableYetError('Object not available yet')
             raise ObjectNotFoundError('Object not found')
 
         if resp.status_code == 405:
@@ -291,59 +1494,303 @@ class BillogramAPI(object):
             'INVALID_OBJECT_STATE': InvalidObjectStateError,
         }.get(status, RequestDataError)(**errordata)
 
+    def _request(self, method, obj, params=None, data=None,
+                 expect_content_type=None, conditional=False,
+                 response_handler=None):
+        """Perform a HTTP request on the pooled session and check the response
+
+        The request is throttled by the rate limiter and retried according
+        to the retry policy, if those are set. If conditional is set the
+        request is made conditional on validators from an earlier response.
+
+        If response_handler is given the response body is not read up front,
+        instead the handler is called with the response and is responsible
+        for checking it.
+        """
+        url = '{}/{}'.format(self._api_base, obj)
+        headers = {'user-agent': self._user_agent}
+        if data is not None:
+            headers['content-type'] = 'application/json'
+        cache_key = cached = None
+        if conditional and self._validators is not None:
+            cache_key = (
+                obj,
+                tuple(sorted((params or {}).items())),
+                expect_content_type
+            )
+            cached = self._validators.get(cache_key)
+            if cached is not None:
+                headers.update(cached[0])
+        started = time.time()
+        metrics = None
+        if self.hooks:
+            metrics = RequestMetrics(method, obj, started)
+        attempt = 0
+        try:
+            while True:
+                if metrics is not None:
+                    mark = time.time()
+                if self._rate_limiter is not None:
+                    self._rate_limiter.acquire()
+                resp = None
+                if attempt and hasattr(data, 'rewind'):
+                    data.rewind()
+                try:
+                    if metrics is not None:
+                        mark = metrics.lap('wait', mark)
+                        metrics.attempts += 1
+                    try:
+                        resp = self._transport.request(
+                            method,
+                            url,
+                            auth=self._auth,
+                            params=params,
+                            data=data,
+                            headers=headers,
+                            stream=response_handler is not None or
+                            metrics is not None
+                        )
+                    finally:
+                        if metrics is not None and data is not None:
+                            metrics.request_bytes += _sent_bytes(data)
+                    if metrics is not None:
+                        mark = metrics.lap('response', mark)
+                        metrics.status = resp.status_code
+                    if response_handler is not None:
+                        try:
+                            return response_handler(resp)
+                        finally:
+                            resp.close()
+                            if metrics is not None:
+                                metrics.lap('read', mark)
+                                metrics.response_bytes += \
+                                    _streamed_bytes(resp)
+                    if metrics is not None:
+                        metrics.response_bytes += len(resp.content)
+                        mark = metrics.lap('read', mark)
+                    not_modified = cached is not None and \
+                        resp.status_code == 304
+                    if not_modified:
+                        # the remembered response is decoded again, so no
+                        # caller shares data with another
+                        resp = cached[1]
+                    result = self._check_api_response(
+                        resp,
+                        expect_content_type=expect_content_type,
+                        json_loads=self._json_loads
+                    )
+                    if metrics is not None:
+                        metrics.lap('decode', mark)
+                    if cache_key is not None and not not_modified:
+                        self._remember_validators(cache_key, resp)
+                    return result
+                except Exception as e:
+                    if self._retry is None:
+                        raise
+                    delay = self._retry.get_delay(
+                        method,
+                        e,
+                        attempt,
+                        time.time() - started,
+                        resp is not None and resp.headers.get('retry-after')
+                        or None
+                    )
+                    if delay is None:
+                        raise
+                time.sleep(delay)
+                if metrics is not None:
+                    metrics.phases['wait'] = \
+                        metrics.phases.get('wait', 0) + delay
+                attempt += 1
+        except Exception as e:
+            if metrics is not None:
+                metrics.exception = e
+            raise
+        finally:
+            if method != 'GET':
+                with self._lock:
+                    self._write_generation += 1
+            if metrics is not None:
+                metrics.elapsed = time.time() - started
+                for hook in self.hooks:
+                    hook.request_finished(metrics)
+
+    def _remember_validators(self, cache_key, resp):
+        validators = {}
+        if resp.headers.get('etag'):
+            validators['if-none-match'] = resp.headers['etag']
+        if resp.headers.get('last-modified'):
+            validators['if-modified-since'] = resp.headers['last-modified']
+        if validators:
+            body = _BufferedResponse(
+                resp.status_code,
+                {'content-type': resp.headers.get('content-type')},
+                resp.content
+            )
+            self._validators.set(cache_key, (validators, body))
+        else:
+            self._validators.invalidate(cache_key)
+
     def get(self, obj, params=None, expect_content_type=None):
         "Perform a HTTP GET request to the Billogram API"
-        url = '{}/{}'.format(self._api_base, obj)
-        return self._check_api_response(
-            requests.get(
-                url,
-                auth=self._auth,
+        def request():
+            # only plain object reads are worth remembering, query pages
+            # and PDFs are large and rarely fetched again unchanged
+            return self._request(
+                'GET',
+                obj,
                 params=params,
-                headers={'user-agent': self._user_agent}
+                expect_content_type=expect_content_type,
+                conditional=not params and not obj.endswith('.pdf')
+            )
+
+        if self._in_flight is None:
+            return request()
+        return self._in_flight.call(
+            (
+                self._write_generation,
+                obj,
+                tuple(sorted((params or {}).items())),
+                expect_content_type
             ),
-            expect_content_type=expect_content_type
+            request
         )
 
-    def post(self, obj, data):
-        "Perform a HTTP POST request to the Billogram API"
-        url = '{}/{}'.format(self._api_base, obj)
-        return self._check_api_response(
-            requests.post(
-                url,
-                auth=self._auth,
-                data=json.dumps(data),
-                headers={
-                    'content-type': 'application/json',
-                    'user-agent': self._user_agent
-                }
+    def _download_content(self, obj, params, out):
+        """Stream the base64 encoded 'content' field of a GET response into
+        the binary file object out, returning the number of bytes written
+
+        Only a small part of the response is held in memory at a time. If the
+        request is retried after writing has started, out is rewound to its
+        original position when possible.
+        """
+        start = None
+        if getattr(out, 'seekable', None) and out.seekable():
+            start = out.tell()
+        decoders = []
+
+        def handler(resp):
+            if decoders and decoders[-1].written:
+                if start is None:
+                    raise BillogramAPIError(
+                        'Download interrupted and output can not be rewound'
+                    )
+                out.seek(start)
+                out.truncate()
+            decoder = _Base64FieldDecoder('content', out)
+            decoders.append(decoder)
+            if resp.status_code == 200 and \
+                    resp.headers.get('content-type') == 'application/json':
+                for chunk in resp.iter_content(64 * 1024):
+                    decoder.feed(chunk)
+                body = decoder.finish()
+            else:
+                # errors are reported in small responses
+                body = resp.content
+            data = self._check_api_response(
+                _BufferedResponse(resp.status_code, resp.headers, body),
+                expect_content_type='application/json',
+                json_loads=self._json_loads
             )
+            if 'content' not in (data.get('data') or {}):
+                raise ServiceMalfunctioningError(
+                    'Response data missing content field'
+                )
+            return decoder.written
+
+        return self._request(
+            'GET',
+            obj,
+            params=params,
+            response_handler=handler
         )
 
+    def _serialize(self, data):
+        """Encode request data into a JSON request body, streaming bodies
+        that are already encoded are passed through unchanged"""
+        if isinstance(data, _Base64JSONBody):
+            return data
+        body = self._json_dumps(data)
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return body
+
+    def post(self, obj, data):
+        "Perform a HTTP POST request to the Billogram API"
+        return self._request('POST', obj, data=self._serialize(data))
+
     def put(self, obj, data):
         "Perform a HTTP PUT request to the Billogram API"
-        url = '{}/{}'.format(self._api_base, obj)
-        return self._check_api_response(
-            requests.put(
-                url,
-                auth=self._auth,
-                data=json.dumps(data),
-                headers={
-                    'content-type': 'application/json',
-                    'user-agent': self._user_agent
-                }
-            )
-        )
+        return self._request('PUT', obj, data=self._serialize(data))
 
     def delete(self, obj):
         "Perform a HTTP DELETE request to the Billogram API"
-        url = '{}/{}'.format(self._api_base, obj)
-        return self._check_api_response(
-            requests.delete(
-                url,
-                auth=self._auth,
-                headers={'user-agent': self._user_agent}
+        return self._request('DELETE', obj)
+
+
+def replay(path, api, speed=1, max_workers=10):
+    """Replay the requests recorded in a cassette through a BillogramAPI
+
+    Requests are started at the pace they were recorded at, sped up by
+    'speed', or as fast as possible if speed is None, and made by up to
+    max_workers threads. Recorded URL paths are taken relative to the API
+    base of api, which may for instance point at a local stand-in, or use
+    a ReplayTransport to measure the client alone. Responses are checked
+    like any other, but not kept. Returns a ReplayReport.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        from urllib.parse import urlsplit
+    except ImportError:
+        from urlparse import urlsplit
+
+    base_path = urlsplit(api._api_base).path.rstrip('/') + '/'
+    report = ReplayReport()
+    lock = threading.Lock()
+    # bound the number of requests waiting for a worker
+    slots = threading.BoundedSemaphore(2 * max_workers)
+
+    def perform(entry, due):
+        started = time.time()
+        path = entry['p']
+        if path.startswith(base_path):
+            path = path[len(base_path):]
+        data = None
+        if 'b' in entry or 'bx' in entry:
+            data = _cassette_decode(entry, 'b')
+        error = None
+        try:
+            api._request(
+                entry['m'],
+                path.lstrip('/'),
+                params=entry.get('q'),
+                data=data
             )
-        )
+        except Exception as e:
+            error = type(e).__name__
+        finally:
+            slots.release()
+        with lock:
+            report.requests += 1
+            report.durations.append(time.time() - started)
+            report.max_lag = max(report.max_lag, started - due)
+            if error is not None:
+                report.errors[error] = report.errors.get(error, 0) + 1
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for entry in _read_cassette(path):
+            due = time.time()
+            if speed:
+                due = report.started + entry['t'] / speed
+                if due > time.time():
+                    time.sleep(due - time.time())
+            slots.acquire()
+            executor.submit(perform, entry, due)
+    finally:
+        executor.shutdown(wait=True)
+    report.elapsed = time.time() - report.started
+    return report
 
 
 class SingletonObject(object):
@@ -432,12 +1879,193 @@ class SimpleObject(SingletonObject):
     def __getattr__(self, key):
         return self._data[key]
 
+    def update(self, data):
+        "Modify the remote object with a partial or complete structure"
+        url = self._url
+        super(SimpleObject, self).update(data)
+        self._object_class._invalidate(url)
+        self._object_class._invalidate(self._url)
+        return self
+
     def delete(self):
         "Remove the remote object from the database"
-        self._api.delete(self._url)
+        url = self._url
+        self._api.delete(url)
+        self._object_class._invalidate(url)
         return None
 
 
+class _Projection(object):
+    "Field names kept by compact objects, and their positions"
+    __slots__ = ('fields', 'index')
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.index = dict((field, pos) for pos, field in enumerate(fields))
+
+
+class _CompactObjectMixin(object):
+    """Compact representation of objects in query results
+
+    Keeps only the values of the fields in a projection, in a tuple, until
+    any other data is needed. The complete object is then fetched through
+    the regular refresh method.
+    """
+    __slots__ = ()
+
+    def __init__(self, api, object_class, projection, values):
+        self._api = api
+        self._object_class = object_class
+        self._data = None
+        self._projection = projection
+        self._values = values
+
+    def __getitem__(self, key):
+        "Dict-like access to object data"
+        if self._data is None:
+            pos = self._projection.index.get(key)
+            if pos is not None:
+                return self._values[pos]
+        return self.data[key]
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return self[key]
+
+
+class CompactSimpleObject(_CompactObjectMixin, SimpleObject):
+    "Compact version of SimpleObject, see Query.compact"
+    __slots__ = ('_projection', '_values')
+
+
+class MemoryCheckpointStore(object):
+    "Keeps sync checkpoints in memory only, for the lifetime of the object"
+    def __init__(self):
+        self._checkpoints = {}
+
+    def load(self, key):
+        "Return the checkpoint saved under key, or None"
+        return self._checkpoints.get(key)
+
+    def save(self, key, value):
+        "Save the checkpoint value under key"
+        self._checkpoints[key] = value
+
+
+class FileCheckpointStore(object):
+    """Keeps sync checkpoints in a JSON file
+
+    The file is rewritten atomically on every save, so a crash never leaves
+    it half written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except IOError:
+            return {}
+
+    def load(self, key):
+        "Return the checkpoint saved under key, or None"
+        with self._lock:
+            return self._read().get(key)
+
+    def save(self, key, value):
+        "Save the checkpoint value, a JSON serializable dict, under key"
+        import os
+        with self._lock:
+            checkpoints = self._read()
+            checkpoints[key] = value
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps(checkpoints).encode('utf-8'))
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+
+
+class SqliteCheckpointStore(object):
+    """Keeps sync checkpoints in a table of a SQLite database
+
+    The table is created if it does not exist.
+    """
+    def __init__(self, path, table='billogram_checkpoints'):
+        import sqlite3
+        self._table = table
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS "{}" '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL)'.format(table)
+            )
+
+    def load(self, key):
+        "Return the checkpoint saved under key, or None"
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM "{}" WHERE key = ?'.format(self._table),
+                (key,)
+            ).fetchone()
+        return row and json.loads(row[0]) or None
+
+    def save(self, key, value):
+        "Save the checkpoint value, a JSON serializable dict, under key"
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO "{}" (key, value) '
+                'VALUES (?, ?)'.format(self._table),
+                (key, json.dumps(value))
+            )
+
+    def close(self):
+        self._db.close()
+
+
+def _field_value(data, field):
+    "Look up a possibly dotted field path in object data, or None"
+    for name in field.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(name)
+    return data
+
+
+def _field_text(value):
+    "Text form of a field value, as compared by the filters of a query"
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, basestring):
+        return value
+    return '{}'.format(value)
+
+
+def _flatten(data, prefix=''):
+    """Flatten nested dicts in object data into one dict with dotted keys,
+    other values are kept as they are"""
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict) and value:
+            flat.update(_flatten(value, '{}{}.'.format(prefix, key)))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def _export_value(value):
+    "Value of a field as written to a flat export format"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
 class Query(object):
     """Builds queries and fetches pages of remote objects
 
@@ -449,13 +2077,19 @@ class Query(object):
 
     The exact fields and special queries available for each object type varies,
     see the online documentation for details.
+
+    The total count of matched objects is remembered from every page fetched
+    and reused until the filter changes. Set count_max_age to a number of
+    seconds to have a remembered count refetched once it is older than that.
     """
     def __init__(self, type_class):
         self._type_class = type_class
         self._filter = {}
         self._count_cached = None
+        self.count_max_age = None
         self._page_size = 100
         self._order = {}
+        self._projection = None
 
     def _make_query(self, page_number=1, page_size=None):
         query_args = {
@@ -463,10 +2097,26 @@ class Query(object):
             'page': page_number,
         }
         query_args.update(self._get_queryargs())
+        filter = self._filter
         resp = self._type_class.api.get(self._type_class._url_name, query_args)
-        self._count_cached = resp['meta']['total_count']
+        if self._filter is filter:
+            # the count is only valid if the filter was not changed meanwhile
+            self._set_count(resp['meta']['total_count'])
         return resp
 
+    def _set_count(self, count):
+        # count and time are replaced together so readers in other threads
+        # never see a mix of old and new
+        self._count_cached = (count, _monotonic())
+
+    def _get_count(self):
+        "The remembered count, or None if there is none or it is too old"
+        cached = self._count_cached
+        if cached is None or self.count_max_age is not None and \
+                cached[1] + self.count_max_age < _monotonic():
+            return None
+        return cached[0]
+
     def _get_queryargs(self):
         args = {}
         args.update(self.filter)
@@ -477,11 +2127,12 @@ class Query(object):
     def count(self):
         """Total amount of objects matched by the current query, reading this
         may cause a remote request"""
-        if self._count_cached is None:
+        count = self._get_count()
+        if count is None:
             # make a query for a single result,
             # this will update the cached count
-            self._make_query(1, 1)
-        return self._count_cached
+            count = self._make_query(1, 1)['meta']['total_count']
+        return count
 
     @property
     def total_pages(self):
@@ -540,6 +2191,55 @@ class Query(object):
             self._order = {}
         return self
 
+    @property
+    def projection(self):
+        """Fields kept in the objects of query results, or None to keep
+        complete objects, see the compact method"""
+        return self._projection and self._projection.fields
+
+    @projection.setter
+    def projection(self, value):
+        if value:
+            id_field = self._type_class._object_id_field
+            fields = tuple(value)
+            if id_field not in fields:
+                fields = (id_field,) + fields
+            self._projection = _Projection(fields)
+        else:
+            self._projection = None
+        return self
+
+    def compact(self, *fields):
+        """Only keep the listed fields in the objects of query results
+
+        Compact objects store just the values of these fields, which makes
+        large result sets take much less memory. Accessing any other field,
+        or the data property, fetches the complete object by refreshing it.
+        The identification field of the object type is always kept. Nested
+        fields are named by dotted paths such as 'customer.customer_no', and
+        are accessed by the same name. Call without fields to return to
+        complete objects.
+        """
+        self.projection = fields
+        return self
+
+    def _make_objects(self, datas):
+        type_class = self._type_class
+        if self._projection is None:
+            return [
+                type_class._object_class(type_class.api, type_class, o)
+                for o in datas
+            ]
+        projection = self._projection
+        return [
+            type_class._compact_object_class(
+                type_class.api,
+                type_class,
+                projection,
+                tuple([_field_value(o, field) for field in projection.fields])
+            ) for o in datas
+        ]
+
     def make_filter(self, filter_type=None, filter_field=None,
                     filter_value=None):
         if None in (filter_type, filter_field, filter_value):
@@ -580,25 +2280,898 @@ class Query(object):
     def get_page(self, page_number):
         "Fetch objects for the one-based page number"
         resp = self._make_query(int(page_number))
-        return [
-            self._type_class._object_class(
-                self._type_class.api,
-                self._type_class,
-                o
-            ) for o in resp['data']
-        ]
+        hooks = self._type_class.api.hooks
+        if not hooks:
+            return self._make_objects(resp['data'])
+        started = time.time()
+        objects = self._make_objects(resp['data'])
+        elapsed = time.time() - started
+        for hook in hooks:
+            hook.objects_built(
+                self._type_class.url_name,
+                len(objects),
+                elapsed
+            )
+        return objects
+
+    def iter_all(self, max_workers=None, window=None, prefetch=None):
+        """Iterate over all matched objects
 
-    def iter_all(self):
-        "Iterate over all matched objects"
+        By default pages are fetched one at a time, when needed. Pass
+        max_workers to fetch pages concurrently using that many threads, or
+        prefetch to have that many pages fetched in the background ahead of
+        the page being processed. Objects are always yielded in page order.
+
+        'window' limits how many pages may be fetched ahead of the consumer,
+        it defaults to one more than prefetch, or to twice the number of
+        workers. Closing the iterator early cancels pages not yet fetched.
+        """
         # make a copy of ourselves so parameters can't be changed behind
         # our back
         import copy
         qry = copy.copy(self)
-        # iterate over every object on every page
-        for page_number in range(1, qry.total_pages+1):
-            page = qry.get_page(page_number)
-            for obj in page:
+        # the first page tells how many pages there are in total, so no
+        # separate count request is needed
+        first_page = qry.get_page(1)
+        if self.filter == qry.filter:
+            self._count_cached = qry._count_cached
+        if (not max_workers or max_workers <= 1) and not prefetch:
+            # iterate over every object on every page
+            for obj in first_page:
                 yield obj
+            del first_page
+            for page_number in range(2, qry.total_pages+1):
+                page = qry.get_page(page_number)
+                for obj in page:
+                    yield obj
+            return
+        # the remaining pages can then be fetched in the background
+        fetched = {1: first_page}
+        del first_page
+
+        def get_page(page_number):
+            if page_number in fetched:
+                return fetched.pop(page_number)
+            return qry.get_page(page_number)
+
+        if prefetch and not window:
+            window = prefetch + 1
+        pages = _iter_concurrent(
+            get_page,
+            range(1, qry.total_pages+1),
+            max_workers or 1,
+            window
+        )
+        try:
+            for page in pages:
+                for obj in page:
+                    yield obj
+        finally:
+            pages.close()
+
+    def export(self, out, format='csv', fields=None, max_workers=None):
+        """Write all matched objects to a CSV, JSON Lines or Parquet file
+
+        'out' is a file path or an open file object, in text mode for 'csv'
+        and 'jsonl' formats and binary mode for 'parquet'. Parquet requires
+        the pyarrow package.
+
+        'fields' lists the fields to export, nested fields are named by
+        dotted paths such as 'customer.customer_no'. For a compact query the
+        fields of the projection are exported by default, so the objects are
+        never refreshed. Otherwise all fields found in the objects of the
+        first page are exported by default, with nested objects flattened the
+        same way, and for 'jsonl' the objects are written unchanged. Lists
+        and objects that are not flattened are written as JSON text.
+
+        Parquet column types are taken from the first page. Integer columns
+        are widened to floating point when needed, any other value of a
+        different type raises ValueError rather than being converted.
+
+        Objects are written page by page as they are fetched, so memory use
+        does not depend on the number of objects. Pass max_workers to fetch
+        pages concurrently, as for iter_all. Returns the number of objects
+        written.
+        """
+        import io
+        import itertools
+
+        assert format in ('csv', 'jsonl', 'parquet')
+        if isinstance(out, basestring):
+            if format == 'parquet':
+                f = io.open(out, 'wb')
+            else:
+                f = io.open(out, 'w', encoding='utf-8', newline='')
+            with f:
+                return self.export(f, format, fields, max_workers)
+        projected = set(self.projection or ())
+        if fields is None and projected:
+            fields = list(self.projection)
+
+        def rows():
+            for obj in self.iter_all(max_workers=max_workers):
+                if fields is None:
+                    yield _flatten(obj.data), obj
+                    continue
+                row = {}
+                for field in fields:
+                    if field in projected:
+                        # kept by compact objects under the full name
+                        row[field] = obj[field]
+                        continue
+                    head, _, rest = field.partition('.')
+                    try:
+                        value = obj[head]
+                    except KeyError:
+                        value = None
+                    if rest:
+                        value = _field_value(value, rest)
+                    row[field] = value
+                yield row, obj
+
+        count = 0
+        columns = fields
+        page_rows = rows()
+        if columns is None and format != 'jsonl':
+            # later objects may have fields the first one lacks, e.g. when
+            # it has an empty nested object
+            first = list(itertools.islice(page_rows, self.page_size))
+            columns = sorted(set().union(*[row for row, obj in first]))
+            page_rows = itertools.chain(first, page_rows)
+        if format == 'jsonl':
+            for row, obj in page_rows:
+                data = fields is None and obj.data or row
+                out.write(json.dumps(data, sort_keys=fields is None))
+                out.write('\n')
+                count += 1
+        elif format == 'csv':
+            import csv
+            writer = None
+            for row, obj in page_rows:
+                if writer is None:
+                    writer = csv.writer(out)
+                    writer.writerow(columns)
+                writer.writerow([
+                    _export_value(row.get(column)) for column in columns
+                ])
+                count += 1
+            if writer is None and columns:
+                csv.writer(out).writerow(columns)
+        else:
+            writer = None
+            batch = []
+            for row, obj in page_rows:
+                batch.append(dict(
+                    (column, _export_value(row.get(column)))
+                    for column in columns
+                ))
+                if len(batch) >= self.page_size:
+                    writer = self._write_parquet(out, writer, columns, batch)
+                    count += len(batch)
+                    batch = []
+            if batch or writer is None:
+                writer = self._write_parquet(out, writer, columns, batch)
+                count += len(batch)
+            writer.close()
+        return count
+
+    @staticmethod
+    def _write_parquet(out, writer, columns, batch):
+        "Write a batch of rows to a parquet file, creating the writer"
+        import pyarrow
+        import pyarrow.parquet
+        columns = columns or []
+        table = pyarrow.Table.from_pydict(dict(
+            (column, [row.get(column) for row in batch])
+            for column in columns
+        ))
+        if writer is None:
+            # columns without values in the first batch are taken as text
+            schema = pyarrow.schema([
+                field.type == pyarrow.null() and
+                field.with_type(pyarrow.string()) or field
+                for field in table.schema
+            ])
+            writer = pyarrow.parquet.ParquetWriter(out, schema)
+        arrays = []
+        for field in writer.schema:
+            array = table.column(field.name)
+            if array.type != field.type:
+                widened = pyarrow.types.is_integer(array.type) and \
+                    pyarrow.types.is_floating(field.type)
+                if array.type != pyarrow.null() and not widened:
+                    raise ValueError(
+                        'Column {!r} was written as {} but later has {} '
+                        'values'.format(field.name, field.type, array.type)
+                    )
+                array = array.cast(field.type)
+            arrays.append(array)
+        writer.write_table(pyarrow.Table.from_arrays(
+            arrays,
+            schema=writer.schema
+        ))
+        return writer
+
+    def iter_changed(self, store, key=None, timestamp_field='updated_at'):
+        """Iterate over matched objects changed since the previous run
+
+        Objects are fetched newest first by ordering on timestamp_field, and
+        iteration stops at the first object not changed since the high-water
+        mark saved in the checkpoint store 'store' by the previous run. Use a
+        FileCheckpointStore, a SqliteCheckpointStore or any object with
+        load(key) and save(key, value) methods. 'key' names the checkpoint,
+        by default it is derived from the object type and filter.
+
+        Timestamps only have a resolution of one second, so objects changed
+        at the exact time of the mark are delivered again by the next run,
+        as they may have changed again within that second. The new mark is
+        only saved once iteration has finished, so if the run is aborted or
+        crashes the next run starts over from the previous mark. Objects may
+        thus be seen more than once, but are never skipped.
+        """
+        import copy
+        qry = copy.copy(self)
+        qry.order = {'order_field': timestamp_field, 'order_direction': 'desc'}
+        if qry.projection and timestamp_field not in qry.projection:
+            qry.projection = qry.projection + (timestamp_field,)
+        if key is None:
+            key = '{}:{}:{}'.format(
+                self._type_class.url_name,
+                timestamp_field,
+                json.dumps(self.filter, sort_keys=True)
+            )
+        checkpoint = store.load(key) or {}
+        mark = checkpoint.get('high_water_mark')
+
+        new_mark = None
+        for obj in qry.iter_all():
+            stamp = obj[timestamp_field]
+            if new_mark is None:
+                new_mark = stamp
+            if mark is not None and stamp < mark:
+                break
+            yield obj
+
+        if new_mark is None or new_mark == mark:
+            return
+        store.save(key, {'high_water_mark': new_mark})
+
+
+def _filter_test(filter_type, filter_field, filter_value):
+    """Local equivalent of a server side filter, a function of object data,
+    or None for special queries"""
+    text = _field_text(filter_value)
+    if filter_type == 'field':
+        return lambda data: \
+            _field_text(_field_value(data, filter_field)) == text
+    if filter_type == 'field-prefix':
+        text = text.lower()
+        return lambda data: (
+            _field_text(_field_value(data, filter_field)) or ''
+        ).lower().startswith(text)
+    if filter_type == 'field-search':
+        text = text.lower()
+        return lambda data: text in (
+            _field_text(_field_value(data, filter_field)) or ''
+        ).lower()
+    return None
+
+
+class _Condition(object):
+    "A filter of a CompositeQuery, with its local equivalent if any"
+    __slots__ = ('filter', 'test', 'description')
+
+    def __init__(self, filter, test, description):
+        self.filter = filter
+        self.test = test
+        self.description = description
+
+
+class QueryPlanStep(object):
+    """One step of the plan for a CompositeQuery
+
+    'action' is one of 'drive' (the query whose objects are returned),
+    'intersect' (a query whose ids the results must be among), 'merge' (a
+    query whose objects are added to the results), 'check' (a filter tested
+    locally on the objects) or 'local' (a local predicate). 'count' and
+    'requests' are the number of objects matched and page requests needed,
+    None for local steps.
+    """
+    __slots__ = ('action', 'description', 'count', 'requests', 'query', 'test')
+
+    def __init__(self, action, description, count=None, query=None,
+                 test=None):
+        self.action = action
+        self.description = description
+        self.count = count
+        self.requests = query is not None and query.total_pages or None
+        self.query = query
+        self.test = test
+
+    def __repr__(self):
+        return '<QueryPlanStep {} {}>'.format(self.action, self.description)
+
+    def __str__(self):
+        if self.query is None:
+            return '{:<9} {} (local)'.format(self.action, self.description)
+        return '{:<9} {} ({} objects, {} pages)'.format(
+            self.action,
+            self.description,
+            self.count,
+            self.requests
+        )
+
+
+class CompositeQuery(object):
+    """Query combining several filters, run as concurrent single-filter
+    queries
+
+    The Billogram service only filters on one field at a time. With
+    match='all', objects must match every filter: each filter is counted
+    by the service and the most selective one drives the query. The other
+    filters are checked locally on the objects it returns, except special
+    queries, whose matching ids are fetched and intersected with. With
+    match='any' the objects matched by each filter are merged. Objects are
+    deduplicated by id as they stream in.
+
+    Predicates added by filter_range and where are always applied locally.
+    Call explain to see the plan and its cost in requests.
+
+    Local checks compare fields like LocalMirror does, taking field names as
+    dotted paths in the object data. Pass local_filters=False to fetch and
+    intersect every filter on the service instead.
+    """
+    def __init__(self, type_class, match='all', local_filters=True):
+        assert match in ('all', 'any')
+        self._type_class = type_class
+        self._match = match
+        self._local_filters = local_filters
+        self._template = type_class.query()
+        self._conditions = []
+        self._predicates = []
+
+    @property
+    def page_size(self):
+        "Number of objects to fetch per page request"
+        return self._template.page_size
+
+    @page_size.setter
+    def page_size(self, value):
+        self._template.page_size = value
+
+    @property
+    def order(self):
+        return self._template.order
+
+    @order.setter
+    def order(self, value):
+        self._template.order = value
+
+    def compact(self, *fields):
+        """Only keep the listed fields in the objects returned, see
+        Query.compact"""
+        self._template.compact(*fields)
+        return self
+
+    def _add_filter(self, filter_type, filter_field, filter_value, test=None):
+        qry = self._type_class.query()
+        qry.make_filter(filter_type, filter_field, filter_value)
+        if not self._local_filters:
+            test = None
+        elif test is None:
+            test = _filter_test(filter_type, filter_field, filter_value)
+        self._conditions.append(_Condition(
+            qry.filter,
+            test,
+            '{} {} = {!r}'.format(filter_type, filter_field, filter_value)
+        ))
+        return self
+
+    def filter_field(self, filter_field, filter_value):
+        "Add a filter on a basic field, look for exact matches"
+        return self._add_filter('field', filter_field, filter_value)
+
+    def filter_prefix(self, filter_field, filter_value):
+        "Add a filter on a basic field, look for prefix matches"
+        return self._add_filter('field-prefix', filter_field, filter_value)
+
+    def filter_search(self, filter_field, filter_value):
+        "Add a filter on a basic field, look for substring matches"
+        return self._add_filter('field-search', filter_field, filter_value)
+
+    def filter_special(self, filter_field, filter_value):
+        "Add a filter on a special query"
+        return self._add_filter('special', filter_field, filter_value)
+
+    def search(self, search_terms):
+        "Add a full data search (exact meaning depends on object type)"
+        return self._add_filter('special', 'search', search_terms)
+
+    def filter_range(self, filter_field, start=None, end=None):
+        """Keep objects with a field value from start up to, but not
+        including, end. Dates are compared in their ISO 8601 form."""
+        if hasattr(start, 'isoformat'):
+            start = start.isoformat()
+        if hasattr(end, 'isoformat'):
+            end = end.isoformat()
+
+        def test(data):
+            value = _field_value(data, filter_field)
+            return value is not None and \
+                (start is None or value >= start) and \
+                (end is None or value < end)
+        return self.where(
+            test,
+            'range {} from {!r} to {!r}'.format(filter_field, start, end)
+        )
+
+    def where(self, predicate, description=None):
+        "Keep objects for whose data the predicate function returns true"
+        self._predicates.append((
+            predicate,
+            description or getattr(predicate, '__name__', repr(predicate))
+        ))
+        return self
+
+    def _sub_query(self, condition):
+        import copy
+        qry = copy.copy(self._template)
+        qry.filter = condition.filter
+        return qry
+
+    def plan(self, max_workers=4):
+        """Count the objects matched by each filter and work out how to run
+        the query, returns a list of QueryPlanStep"""
+        conditions = self._conditions or [_Condition({}, None, 'all objects')]
+        queries = [self._sub_query(c) for c in conditions]
+        counts = list(_iter_concurrent(
+            lambda qry: qry.count,
+            queries,
+            max_workers
+        ))
+        if self._match == 'any':
+            steps = [
+                QueryPlanStep('merge', c.description, n, qry)
+                for c, qry, n in zip(conditions, queries, counts)
+            ]
+        else:
+            driver = counts.index(min(counts))
+            steps = [QueryPlanStep(
+                'drive',
+                conditions[driver].description,
+                counts[driver],
+                queries[driver]
+            )]
+            for i, condition in enumerate(conditions):
+                if i == driver:
+                    continue
+                if condition.test is not None:
+                    steps.append(QueryPlanStep(
+                        'check',
+                        condition.description,
+                        test=condition.test
+                    ))
+                else:
+                    steps.append(QueryPlanStep(
+                        'intersect',
+                        condition.description,
+                        counts[i],
+                        queries[i]
+                    ))
+        for predicate, description in self._predicates:
+            steps.append(QueryPlanStep('local', description, test=predicate))
+        return steps
+
+    def explain(self, max_workers=4):
+        """Describe the plan for running the query and its cost in requests,
+        the filters are counted on the service to work this out"""
+        steps = self.plan(max_workers)
+        lines = ['{}'.format(step) for step in steps]
+        counted = len(self._conditions) or 1
+        pages = sum(step.requests or 0 for step in steps)
+        lines.append('{} count requests, at most {} page requests'.format(
+            counted,
+            pages
+        ))
+        return '\n'.join(lines)
+
+    def iter_all(self, max_workers=4, window=None):
+        """Iterate over all objects matched by the query
+
+        Page requests for all filters are made concurrently by max_workers
+        threads, 'window' limits how many pages may be fetched ahead of the
+        consumer as for Query.iter_all.
+        """
+        id_field = self._type_class._object_id_field
+        steps = self.plan(max_workers)
+        fetched = [step for step in steps if step.query is not None]
+        if self._match == 'all' and min(step.count for step in fetched) == 0:
+            return
+        tests = [step.test for step in steps if step.query is None]
+        # ids to intersect with must be complete before the driving pages
+        # are looked at, so fetch those first
+        fetched.sort(key=lambda step: step.action == 'drive')
+        id_sets = dict(
+            (step, set()) for step in fetched if step.action == 'intersect'
+        )
+        tasks = [
+            (step, page_number)
+            for step in fetched
+            for page_number in range(1, step.requests+1)
+        ]
+
+        def fetch(task):
+            step, page_number = task
+            return step, step.query._make_query(page_number)['data']
+
+        seen = set()
+        pages = _iter_concurrent(fetch, tasks, max_workers, window)
+        try:
+            for step, datas in pages:
+                if step in id_sets:
+                    id_sets[step].update(data[id_field] for data in datas)
+                    continue
+                keep = []
+                for data in datas:
+                    obj_id = data[id_field]
+                    if obj_id in seen:
+                        continue
+                    if not all(obj_id in ids for ids in id_sets.values()):
+                        continue
+                    if not all(test(data) for test in tests):
+                        continue
+                    seen.add(obj_id)
+                    keep.append(data)
+                for obj in self._template._make_objects(keep):
+                    yield obj
+        finally:
+            pages.close()
+
+
+class _MemoryMirrorStore(object):
+    """Object store for LocalMirror keeping everything in dicts
+
+    Indexes for a field are built on the first lookup on it, and then kept
+    up to date: exact value to ids, and a sorted list of lowercased values
+    used both for prefix lookups by bisection and for substring scans.
+    """
+    def __init__(self):
+        self._objects = {}
+        self._exact = {}
+        self._sorted = {}
+
+    def __len__(self):
+        return len(self._objects)
+
+    def clear(self):
+        self._objects.clear()
+        self._exact.clear()
+        self._sorted.clear()
+
+    def get(self, obj_id):
+        return self._objects.get(obj_id)
+
+    def put(self, obj_id, data):
+        import bisect
+        old = self._objects.get(obj_id)
+        self._objects[obj_id] = data
+        for field, index in self._exact.items():
+            if old is not None:
+                old_text = _field_text(_field_value(old, field))
+                index.get(old_text, set()).discard(obj_id)
+            index.setdefault(
+                _field_text(_field_value(data, field)),
+                set()
+            ).add(obj_id)
+        for field, entries in self._sorted.items():
+            if old is not None:
+                text = _field_text(_field_value(old, field))
+                if text is not None:
+                    pos = bisect.bisect_left(entries, (text.lower(), obj_id))
+                    if pos < len(entries) and \
+                            entries[pos] == (text.lower(), obj_id):
+                        del entries[pos]
+            text = _field_text(_field_value(data, field))
+            if text is not None:
+                bisect.insort(entries, (text.lower(), obj_id))
+
+    def put_many(self, items):
+        for obj_id, data in items:
+            self.put(obj_id, data)
+
+    def _exact_index(self, field):
+        if field not in self._exact:
+            index = {}
+            for obj_id, data in self._objects.items():
+                index.setdefault(
+                    _field_text(_field_value(data, field)),
+                    set()
+                ).add(obj_id)
+            self._exact[field] = index
+        return self._exact[field]
+
+    def _sorted_index(self, field):
+        if field not in self._sorted:
+            entries = []
+            for obj_id, data in self._objects.items():
+                text = _field_text(_field_value(data, field))
+                if text is not None:
+                    entries.append((text.lower(), obj_id))
+            entries.sort()
+            self._sorted[field] = entries
+        return self._sorted[field]
+
+    def find(self, mode, field, value):
+        import bisect
+        value = _field_text(value)
+        if mode == 'field':
+            ids = sorted(self._exact_index(field).get(value, ()))
+        elif mode == 'field-prefix':
+            value = value.lower()
+            entries = self._sorted_index(field)
+            ids = []
+            pos = bisect.bisect_left(entries, (value,))
+            while pos < len(entries) and entries[pos][0].startswith(value):
+                ids.append(entries[pos][1])
+                pos += 1
+        else:
+            value = value.lower()
+            ids = [
+                obj_id for text, obj_id in self._sorted_index(field)
+                if value in text
+            ]
+        return [self._objects[obj_id] for obj_id in ids]
+
+
+class _SqliteMirrorStore(object):
+    """Object store for LocalMirror keeping objects in a SQLite database
+
+    Objects are stored as JSON. Exact and prefix lookups on a field use
+    expression indexes on json_extract created on the first lookup on it,
+    substring lookups scan the table. Case is only ignored for ASCII
+    letters, as by the SQLite lower function.
+    """
+    def __init__(self, path, table):
+        import sqlite3
+        self._table = table
+        self._indexed = set()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS "{}" '
+                '(id TEXT PRIMARY KEY, data TEXT NOT NULL)'.format(table)
+            )
+
+    def __len__(self):
+        return self._db.execute(
+            'SELECT count(*) FROM "{}"'.format(self._table)
+        ).fetchone()[0]
+
+    def clear(self):
+        with self._db:
+            self._db.execute('DELETE FROM "{}"'.format(self._table))
+
+    def get(self, obj_id):
+        row = self._db.execute(
+            'SELECT data FROM "{}" WHERE id = ?'.format(self._table),
+            (_field_text(obj_id),)
+        ).fetchone()
+        return row and json.loads(row[0]) or None
+
+    def put(self, obj_id, data):
+        self.put_many([(obj_id, data)])
+
+    def put_many(self, items):
+        "Store (id, data) pairs in a single transaction"
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO "{}" (id, data) '
+                'VALUES (?, ?)'.format(self._table),
+                [
+                    (_field_text(obj_id), json.dumps(data))
+                    for obj_id, data in items
+                ]
+            )
+
+    def _field_expr(self, field):
+        import re
+        assert re.match(r'^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$', field), \
+            'invalid field name'
+        expr = "json_extract(data, '$.{}')".format(field)
+        if field not in self._indexed:
+            with self._db:
+                for suffix, indexed in (('', expr),
+                                        ('_lower', 'lower({})'.format(expr))):
+                    self._db.execute(
+                        'CREATE INDEX IF NOT EXISTS "{0}_{1}{2}" '
+                        'ON "{0}" ({3})'.format(
+                            self._table,
+                            field,
+                            suffix,
+                            indexed
+                        )
+                    )
+            self._indexed.add(field)
+        return expr
+
+    def find(self, mode, field, value):
+        expr = self._field_expr(field)
+        value = _field_text(value)
+        if mode == 'field':
+            # numbers are stored as such in the JSON, match those too
+            candidates = [value]
+            for convert in (int, float):
+                try:
+                    candidates.append(convert(value))
+                except ValueError:
+                    pass
+            where = '{} IN ({})'.format(
+                expr,
+                ', '.join('?' for c in candidates)
+            )
+            args = candidates
+        elif mode == 'field-prefix':
+            where = 'lower({0}) >= ? AND lower({0}) < ?'.format(expr)
+            args = (value.lower(), value.lower() + '\uffff')
+        else:
+            where = 'instr(lower({}), ?) > 0'.format(expr)
+            args = (value.lower(),)
+        rows = self._db.execute(
+            'SELECT data FROM "{}" WHERE {} ORDER BY id'.format(
+                self._table,
+                where
+            ),
+            args
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self):
+        self._db.close()
+
+
+class LocalMirror(object):
+    """Local, indexed copy of a collection of remote objects
+
+    Loads all objects of a SimpleClass, or those matched by a query, into a
+    local store and answers exact, prefix and substring lookups on any field
+    without remote requests. Lookups follow the filter_field, filter_prefix
+    and filter_search methods of Query: exact matches compare the text form
+    of the value, prefix and substring matches ignore case. Nested fields
+    are named by dotted paths like 'contact.email'.
+
+    By default objects are kept in memory. Pass a path to keep them in a
+    SQLite database instead, the mirror then survives restarts and only
+    needs a delta refresh to catch up.
+
+    The mirror is kept fresh by delta refreshes using Query.iter_changed,
+    call refresh() or pass refresh_interval to refresh in a background
+    thread every that many seconds. Objects deleted remotely are only
+    removed by a full reload().
+    """
+    def __init__(self, type_class, path=None, refresh_interval=None,
+                 query=None, timestamp_field='updated_at'):
+        self._type_class = type_class
+        self._query = query or type_class.query()
+        self._timestamp_field = timestamp_field
+        self._lock = threading.RLock()
+        if path is None:
+            self._store = _MemoryMirrorStore()
+            self._checkpoints = MemoryCheckpointStore()
+        else:
+            table = 'billogram_mirror_{}'.format(type_class.url_name)
+            self._store = _SqliteMirrorStore(path, table)
+            self._checkpoints = SqliteCheckpointStore(path)
+        self._checkpoint_key = 'mirror:{}:{}:{}'.format(
+            type_class.url_name,
+            timestamp_field,
+            json.dumps(self._query.filter, sort_keys=True)
+        )
+        self.last_refresh = None
+        self.last_error = None
+        self.refresh()
+        self._stop = threading.Event()
+        if refresh_interval:
+            thread = threading.Thread(
+                target=self._refresh_loop,
+                args=(refresh_interval,)
+            )
+            thread.daemon = True
+            thread.start()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._store)
+
+    def _refresh_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep serving the current data, try again next time
+                self.last_error = e
+
+    def refresh(self):
+        """Fetch objects changed since the last refresh into the mirror,
+        returning the number of objects updated"""
+        import itertools
+        id_field = self._type_class._object_id_field
+        count = 0
+        # objects are stored a page at a time, so the new checkpoint is
+        # only saved once the last of them is stored
+        previous = self._checkpoints.load(self._checkpoint_key)
+        staged = MemoryCheckpointStore()
+        staged.save(self._checkpoint_key, previous)
+        changed = self._query.iter_changed(
+            staged,
+            self._checkpoint_key,
+            self._timestamp_field
+        )
+        while True:
+            batch = [
+                (obj[id_field], obj.data)
+                for obj in itertools.islice(changed, self._query.page_size)
+            ]
+            if not batch:
+                break
+            with self._lock:
+                self._store.put_many(batch)
+            count += len(batch)
+        checkpoint = staged.load(self._checkpoint_key)
+        if checkpoint != previous:
+            self._checkpoints.save(self._checkpoint_key, checkpoint)
+        self.last_refresh = time.time()
+        self.last_error = None
+        return count
+
+    def reload(self):
+        "Discard all local data and load every object again"
+        with self._lock:
+            self._store.clear()
+            self._checkpoints.save(self._checkpoint_key, {})
+        return self.refresh()
+
+    def close(self):
+        "Stop background refreshing and close the local store"
+        self._stop.set()
+        if hasattr(self._store, 'close'):
+            self._store.close()
+            self._checkpoints.close()
+
+    def _wrap(self, datas):
+        return [
+            self._type_class._object_class(
+                self._type_class.api,
+                self._type_class,
+                data
+            ) for data in datas
+        ]
+
+    def get(self, object_id):
+        "Look up a single object by its identification, or None"
+        with self._lock:
+            data = self._store.get(object_id)
+        return data is not None and self._wrap([data])[0] or None
+
+    def filter_field(self, filter_field, filter_value):
+        "Find objects by a field, look for exact matches"
+        with self._lock:
+            return self._wrap(
+                self._store.find('field', filter_field, filter_value)
+            )
+
+    def filter_prefix(self, filter_field, filter_value):
+        "Find objects by a field, look for prefix matches"
+        with self._lock:
+            return self._wrap(
+                self._store.find('field-prefix', filter_field, filter_value)
+            )
+
+    def filter_search(self, filter_field, filter_value):
+        "Find objects by a field, look for substring matches"
+        with self._lock:
+            return self._wrap(
+                self._store.find('field-search', filter_field, filter_value)
+            )
 
 
 class SimpleClass(object):
@@ -606,14 +3179,21 @@ class SimpleClass(object):
 
     Provides methods to search, fetch and create instances of the object type.
 
+    Objects fetched by the 'get' method can be cached locally by setting the
+    'cache' attribute to an ObjectCache. Cached objects are invalidated when
+    modified or deleted through this library, but changes made by other
+    clients are only seen once the cache entry has expired.
+
     See the online documentation for the actual structure of remote objects.
     """
     _object_class = SimpleObject
+    _compact_object_class = CompactSimpleObject
 
     def __init__(self, api, url_name, object_id_field):
         self._api = api
         self._url_name = url_name
         self._object_id_field = object_id_field
+        self.cache = None
 
     def _url_of(self, obj=None, obj_id=None):
         if obj_id is None:
@@ -632,15 +3212,38 @@ class SimpleClass(object):
         "Create a query for objects of this type"
         return Query(self)
 
+    def composite_query(self, match='all', local_filters=True):
+        """Create a query combining several filters for objects of this type,
+        see CompositeQuery"""
+        return CompositeQuery(self, match, local_filters)
+
+    def mirror(self, path=None, refresh_interval=None):
+        """Load all objects of this type into a LocalMirror for fast local
+        lookups, see LocalMirror for the parameters"""
+        return LocalMirror(self, path, refresh_interval)
+
+    def _invalidate(self, url):
+        if self.cache is not None:
+            self.cache.invalidate(url)
+
     def get(self, object_id):
         "Fetch a single object by its identification"
-        resp = self.api.get(self._url_of(obj_id=object_id))
+        url = self._url_of(obj_id=object_id)
+        if self.cache is not None:
+            data = self.cache.get(url)
+            if data is not None:
+                return self._object_class(self.api, self, data)
+        resp = self.api.get(url)
+        if self.cache is not None:
+            self.cache.set(url, resp['data'])
         return self._object_class(self.api, self, resp['data'])
 
     def create(self, data):
         "Create a new object with the given data"
         resp = self.api.post(self.url_name, data)
-        return self._object_class(self.api, self, resp['data'])
+        obj = self._object_class(self.api, self, resp['data'])
+        self._invalidate(self._url_of(obj))
+        return obj
 
 
 class BillogramObject(SimpleObject):
@@ -656,9 +3259,11 @@ class BillogramObject(SimpleObject):
     def perform_event(self, evt_name, evt_data=None):
         """Perform a generic state transition event on billogram object
         """
-        url = '{}/command/{}'.format(self._url, evt_name)
+        obj_url = self._url
+        url = '{}/command/{}'.format(obj_url, evt_name)
         resp = self._api.post(url, evt_data)
         self._data = resp['data']
+        self._object_class._invalidate(obj_url)
         return self
 
     def create_payment(self, amount):
@@ -788,23 +3393,124 @@ class BillogramObject(SimpleObject):
         resp = self._api.get(url, expect_content_type='application/json')
         return base64.b64decode(resp['data']['content'])
 
-    def attach_pdf(self, filepath):
-        """Attach a PDF to the billogram
+    def _save_content(self, url, params, target):
+        if not isinstance(target, basestring):
+            return self._api._download_content(url, params, target)
+        import os
+        try:
+            with open(target, 'wb') as f:
+                return self._api._download_content(url, params, f)
+        except Exception:
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+
+    def save_invoice_pdf(self, target, letter_id=None, invoice_no=None):
+        """Download the PDF content for a specific invoice on this billogram
+        into a file
+
+        'target' is either a file path or a writable binary file object. The
+        PDF is decoded and written as it is downloaded, so memory use does not
+        depend on the size of the PDF. Returns the number of bytes written.
         """
-        import base64
+        url = '{}.pdf'.format(self._url)
+
+        params = {}
+        if letter_id:
+            params['letter_id'] = letter_id
+        if invoice_no:
+            params['invoice_no'] = invoice_no
+        return self._save_content(url, params, target)
+
+    def save_attachment_pdf(self, target):
+        """Download the PDF attachment for the billogram into a file
+
+        'target' is either a file path or a writable binary file object, see
+        save_invoice_pdf.
+        """
+        url = '{}/attachment.pdf'.format(self._url)
+        return self._save_content(url, None, target)
+
+    @staticmethod
+    def _open_pdf_attachment(filepath, filename=None):
+        """Make a streaming request body for the attach event
+
+        Returns the body and a function to call to release its resources.
+        """
+        import mmap
         import os
 
-        with file(filepath) as f:
-            content = f.read()
+        if isinstance(filepath, basestring):
+            f = open(filepath, 'rb')
+            try:
+                body, release = BillogramObject._open_pdf_attachment(
+                    f,
+                    filename or os.path.basename(filepath)
+                )
+            except Exception:
+                f.close()
+                raise
+
+            def close():
+                release()
+                f.close()
+            return body, close
+
+        if not hasattr(filepath, 'read'):
+            # bytes-like object
+            assert filename, 'filename is required when attaching bytes'
+            return _Base64JSONBody(
+                {'filename': filename},
+                'content',
+                filepath,
+                len(filepath)
+            ), lambda: None
+
+        filename = filename or os.path.basename(getattr(filepath, 'name', ''))
+        assert filename, 'filename is required for unnamed file objects'
+        try:
+            offset = filepath.tell()
+            size = os.fstat(filepath.fileno()).st_size - offset
+            mapped = mmap.mmap(filepath.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            # not a regular file, or an empty one, read it as a stream
+            size = None
+            if getattr(filepath, 'seekable', None) and filepath.seekable():
+                offset = filepath.tell()
+                filepath.seek(0, 2)
+                size = filepath.tell() - offset
+                filepath.seek(offset)
+            return _Base64JSONBody(
+                {'filename': filename},
+                'content',
+                filepath,
+                size
+            ), lambda: None
+        return _Base64JSONBody(
+            {'filename': filename},
+            'content',
+            mapped,
+            size,
+            offset
+        ), mapped.close
+
+    def attach_pdf(self, filepath, filename=None):
+        """Attach a PDF to the billogram
 
-        filename = os.path.basename(filepath)
-        return self.perform_event(
-            'attach',
-            {
-                'content': base64.b64encode(content),
-                'filename': filename
-            }
-        )
+        'filepath' is the path of the PDF file, a binary file object to read
+        the PDF from, or the PDF content as bytes. 'filename' is the name
+        given to the attachment, by default the base name of the file. It
+        must be given when passing bytes.
+
+        Files are memory mapped when possible, and the request body is
+        encoded and sent in small chunks, so memory use does not depend on
+        the size of the PDF.
+        """
+        body, release = self._open_pdf_attachment(filepath, filename)
+        try:
+            return self.perform_event('attach', body)
+        finally:
+            release()
 
     def writeoff(self):
         """Write-off remaining fees from a billogram.
@@ -812,6 +3518,11 @@ class BillogramObject(SimpleObject):
         return self.perform_event('writeoff')
 
 
+class CompactBillogramObject(_CompactObjectMixin, BillogramObject):
+    "Compact version of BillogramObject, see Query.compact"
+    __slots__ = ('_projection', '_values')
+
+
 class BillogramQuery(Query):
     """Represents a query for billogram objects
     """
@@ -828,6 +3539,113 @@ class BillogramQuery(Query):
         assert all(isinstance(s, basestring) for s in states)
         return self.filter_field('state', ','.join(states))
 
+    def archive_invoice_pdfs(self, target, max_workers=8, window=None,
+                             progress=None):
+        """Download the invoice PDF of every matched billogram
+
+        'target' is either a directory path, or a zipfile.ZipFile or
+        tarfile.TarFile opened for writing or appending. Each PDF is stored
+        as '<billogram id>.pdf'. PDFs already present in the target are
+        skipped, so an interrupted run can be resumed by running it again.
+
+        Up to max_workers PDFs are downloaded concurrently. When writing to
+        a directory they are streamed straight into the files, for archives
+        at most 'window' PDFs are held in memory waiting to be written.
+
+        Billograms that fail, for instance because they have no invoice yet,
+        do not abort the run. If 'progress' is given it is called with the
+        ArchiveReport after each billogram. Returns the final ArchiveReport.
+        """
+        import io
+        import os
+        import tarfile
+        import zipfile
+
+        report = ArchiveReport()
+        if isinstance(target, zipfile.ZipFile):
+            existing = set(target.namelist())
+        elif isinstance(target, tarfile.TarFile):
+            existing = set(member.name for member in target.members)
+        else:
+            existing = None
+            if not os.path.isdir(target):
+                os.makedirs(target)
+
+        def filename(billogram):
+            return '{}.pdf'.format(billogram['id'])
+
+        def is_present(name):
+            if existing is not None:
+                return name in existing
+            return os.path.exists(os.path.join(target, name))
+
+        def missing():
+            for billogram in self.iter_all():
+                if is_present(filename(billogram)):
+                    report.skipped += 1
+                    continue
+                yield billogram
+
+        def fetch(billogram):
+            try:
+                if existing is not None:
+                    content = io.BytesIO()
+                    billogram.save_invoice_pdf(content)
+                    return BulkResult(billogram, result=content.getvalue())
+                # download to a temporary name so partial files are never
+                # mistaken for complete ones when resuming
+                path = os.path.join(target, filename(billogram))
+                size = billogram.save_invoice_pdf(path + '.part')
+                os.rename(path + '.part', path)
+                return BulkResult(billogram, result=size)
+            except Exception as e:
+                return BulkResult(billogram, exception=e)
+
+        for result in _iter_concurrent(fetch, missing(), max_workers, window):
+            if not result.ok:
+                report.failed.append(result)
+            elif existing is None:
+                report.saved += 1
+                report.bytes += result.result
+            else:
+                name = filename(result.item)
+                content = result.result
+                if isinstance(target, zipfile.ZipFile):
+                    target.writestr(name, content)
+                else:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    info.mtime = time.time()
+                    target.addfile(info, io.BytesIO(content))
+                existing.add(name)
+                report.saved += 1
+                report.bytes += len(content)
+            report.elapsed = time.time() - report.started
+            if progress is not None:
+                progress(report)
+        report.elapsed = time.time() - report.started
+        return report
+
+
+class BillogramCompositeQuery(CompositeQuery):
+    """Composite query for billogram objects, see CompositeQuery"""
+
+    def filter_state_any(self, *states):
+        "Add a filter for billogram objects with any state of the listed ones"
+        if len(states) == 1 and isinstance(
+            states[0],
+            (list, tuple, set, frozenset)
+        ):
+            states = states[0]
+        assert all(isinstance(s, basestring) for s in states)
+        states = frozenset(states)
+        return self._add_filter(
+            'field',
+            'state',
+            ','.join(sorted(states)),
+            test=lambda data: data.get('state') in states
+        )
+
 
 class BillogramClass(SimpleClass):
     """Represents the collection of billogram objects on the Billogram service
@@ -837,6 +3655,7 @@ class BillogramClass(SimpleClass):
     transition them immediately.
     """
     _object_class = BillogramObject
+    _compact_object_class = CompactBillogramObject
 
     def __init__(self, api):
         super(BillogramClass, self).__init__(api, 'billogram', 'id')
@@ -845,6 +3664,38 @@ class BillogramClass(SimpleClass):
         "Create a query for billogram objects"
         return BillogramQuery(self)
 
+    def composite_query(self, match='all', local_filters=True):
+        "Create a query combining several filters for billogram objects"
+        return BillogramCompositeQuery(self, match, local_filters)
+
+    def perform_events(self, events, max_workers=10, window=None):
+        """Perform state transition events on many billogram objects
+
+        'events' is an iterable of (id, event name, event data) tuples, the
+        event data may be left out. Events are performed concurrently by up
+        to max_workers threads, see BillogramObject.perform_event.
+
+        Failures do not abort the run. Returns a list of BulkResult objects,
+        in the same order as the events, with the updated billogram object
+        or the raised exception for each event.
+        """
+        def run(event):
+            obj_id, evt_name, evt_data = (tuple(event) + (None,))[:3]
+            try:
+                billogram = self._object_class(
+                    self.api,
+                    self,
+                    {self._object_id_field: obj_id}
+                )
+                return BulkResult(
+                    event,
+                    result=billogram.perform_event(evt_name, evt_data)
+                )
+            except Exception as e:
+                return BulkResult(event, exception=e)
+
+        return list(_iter_concurrent(run, events, max_workers, window))
+
     def create_and_send(self, data, method):
         """Create the billogram and send it to the recipient in one operation
 
@@ -865,6 +3716,31 @@ class BillogramClass(SimpleClass):
             raise e
         return billogram
 
+    def create_and_send_many(self, datas, method, max_workers=10,
+                             window=None):
+        """Create and send many billograms concurrently
+
+        'datas' is an iterable of billogram data, it is consumed lazily so it
+        may be a generator producing a very large number of billograms. Each
+        one is handled like in create_and_send by up to max_workers threads,
+        a billogram that fails to be sent is deleted again.
+
+        Returns an iterator of BulkResult objects in the same order as the
+        input, with the sent billogram object or the raised exception.
+        """
+        assert method in ('Email', 'Letter', 'Email+Letter')
+
+        def run(data):
+            try:
+                return BulkResult(
+                    data,
+                    result=self.create_and_send(data, method)
+                )
+            except Exception as e:
+                return BulkResult(data, exception=e)
+
+        return _iter_concurrent(run, datas, max_workers, window)
+
     def create_and_sell(self, data):
         """Create the billogram and send it to factoring in one operation
 
@@ -887,7 +3763,25 @@ BillogramExceptions = type(
     }
 )
 
-# just the BillogramAPI class and the exceptions are really part
-# of the call API of this module
-__all__ = ['BillogramAPI', 'BillogramExceptions']
+# the BillogramAPI class, the exceptions and the classes passed to it or
+# created to configure it are the call API of this module
+__all__ = [
+    'BillogramAPI',
+    'BillogramExceptions',
+    'RetryPolicy',
+    'RateLimiter',
+    'ObjectCache',
+    'RequestHook',
+    'PrometheusHook',
+    'OpenTelemetryHook',
+    'Transport',
+    'RequestsTransport',
+    'RecordingTransport',
+    'ReplayTransport',
+    'replay',
+    'MemoryCheckpointStore',
+    'FileCheckpointStore',
+    'SqliteCheckpointStore',
+    'LocalMirror',
+]
 
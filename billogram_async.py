@@ -0,0 +1,689 @@
+# encoding=utf-8
+# Copyright (c) 2013 Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Asyncio client for the Billogram v2 HTTP API
+
+Provides AsyncBillogramAPI, mirroring the BillogramAPI class from the
+billogram_api module with awaitable methods. Responses are checked by the
+same code as in the blocking client, so the same exceptions are raised.
+
+Requires Python 3.6 or later and the aiohttp package.
+"""
+
+import asyncio
+
+import aiohttp
+
+from billogram_api import (
+    API_URL_BASE,
+    USER_AGENT,
+    BillogramAPI,
+    BillogramExceptions,
+    SingletonObject,
+    SimpleObject,
+    Query,
+    SimpleClass,
+    BillogramObject,
+    _CompactObjectMixin,
+    BillogramQuery,
+    BillogramClass,
+    BulkResult,
+    ServiceMalfunctioningError,
+    _Base64FieldDecoder,
+    _Base64JSONBody,
+    _BufferedResponse,
+    _json_dumps,
+)
+
+
+def _blocking_only(name):
+    "Make a method refusing an operation only the blocking client supports"
+    def method(self, *args, **kwargs):
+        raise TypeError(
+            '{}.{} is not supported by the asyncio client, use '
+            'billogram_api.BillogramAPI for it'.format(
+                type(self).__name__,
+                name
+            )
+        )
+    method.__name__ = name
+    method.__doc__ = 'Not supported by the asyncio client'
+    return method
+
+
+async def _iter_body(body):
+    """Adapt a streaming request body to the async iterable aiohttp expects
+
+    The chunks are produced in a worker thread, so reading a large file or
+    mmap does not block the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    chunks = iter(body)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+
+class AsyncBillogramAPI(object):
+    """Asyncio pseudo-connection to the Billogram v2 API
+
+    Objects of this class provide the same call interface as BillogramAPI,
+    but every method performing a remote request is a coroutine.
+    """
+    def __init__(self, auth_user, auth_key, user_agent=None, api_base=None,
+                 pool_maxsize=10, keep_alive=True, session=None,
+                 json_loads=None, json_dumps=None):
+        """Create an asyncio Billogram API connection object
+
+        Pass the API authentication in the auth_user and auth_key parameters.
+        'pool_maxsize' limits the number of connections kept open per host.
+
+        An existing aiohttp.ClientSession can be passed in the session
+        parameter, it is then used as-is and is not closed by the close
+        method. Otherwise a session is created on the first request.
+
+        'json_loads' and 'json_dumps' override the JSON decoder and encoder,
+        as for BillogramAPI.
+
+        The object can be used as an async context manager, the connection
+        pool is closed on exit.
+        """
+        self._auth = aiohttp.BasicAuth(auth_user, auth_key)
+        self._items = None
+        self._customers = None
+        self._billogram = None
+        self._settings = None
+        self._logotype = None
+        self._reports = None
+        self._user_agent = user_agent or USER_AGENT
+        self._api_base = api_base or API_URL_BASE
+        self._pool_maxsize = pool_maxsize
+        self._keep_alive = keep_alive
+        self._owns_session = session is None
+        self._session = session
+        self._json_loads = json_loads
+        self._json_dumps = json_dumps or _json_dumps
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        "Close all pooled connections held by this object"
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def items(self):
+        "Provide access to the items database"
+        if self._items is None:
+            self._items = AsyncSimpleClass(self, 'item', 'item_no')
+        return self._items
+
+    @property
+    def customers(self):
+        "Provide access to the customer database"
+        if self._customers is None:
+            self._customers = AsyncSimpleClass(self, 'customer', 'customer_no')
+        return self._customers
+
+    @property
+    def billogram(self):
+        "Provide access to billogram objects and attached invoices"
+        if self._billogram is None:
+            self._billogram = AsyncBillogramClass(self)
+        return self._billogram
+
+    @property
+    def settings(self):
+        "Provide access to settings for the Billogram account"
+        if self._settings is None:
+            self._settings = AsyncSingletonObject(self, 'settings')
+        return self._settings
+
+    @property
+    def logotype(self):
+        "Provide access to the logotype for the Billogram account"
+        if self._logotype is None:
+            self._logotype = AsyncSingletonObject(self, 'logotype')
+        return self._logotype
+
+    @property
+    def reports(self):
+        "Provide access to the reports database"
+        if self._reports is None:
+            self._reports = AsyncSimpleClass(self, 'report', 'filename')
+        return self._reports
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=self._pool_maxsize,
+                    force_close=not self._keep_alive
+                )
+            )
+        return self._session
+
+    async def _request(self, method, obj, params=None, data=None,
+                       expect_content_type=None):
+        "Perform a HTTP request on the pooled session and check the response"
+        url = '{}/{}'.format(self._api_base, obj)
+        headers = {'user-agent': self._user_agent}
+        if data is not None:
+            headers['content-type'] = 'application/json'
+        if params:
+            params = {k: str(v) for k, v in params.items()}
+        if isinstance(data, _Base64JSONBody):
+            data = _iter_body(data)
+        async with self._get_session().request(
+                method,
+                url,
+                auth=self._auth,
+                params=params,
+                data=data,
+                headers=headers) as resp:
+            content = await resp.read()
+        return BillogramAPI._check_api_response(
+            _BufferedResponse(resp.status, resp.headers, content),
+            expect_content_type=expect_content_type,
+            json_loads=self._json_loads
+        )
+
+    async def get(self, obj, params=None, expect_content_type=None):
+        "Perform a HTTP GET request to the Billogram API"
+        return await self._request(
+            'GET',
+            obj,
+            params=params,
+            expect_content_type=expect_content_type
+        )
+
+    async def _download_content(self, obj, params, out):
+        """Stream the base64 encoded 'content' field of a GET response into
+        the binary file object out, returning the number of bytes written
+
+        See BillogramAPI._download_content, only a small part of the
+        response is held in memory at a time.
+        """
+        url = '{}/{}'.format(self._api_base, obj)
+        headers = {'user-agent': self._user_agent}
+        if params:
+            params = {k: str(v) for k, v in params.items()}
+        decoder = _Base64FieldDecoder('content', out)
+        async with self._get_session().request(
+                'GET',
+                url,
+                auth=self._auth,
+                params=params,
+                headers=headers) as resp:
+            if resp.status == 200 and \
+                    resp.headers.get('content-type') == 'application/json':
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    decoder.feed(chunk)
+                body = decoder.finish()
+            else:
+                # errors are reported in small responses
+                body = await resp.read()
+        data = BillogramAPI._check_api_response(
+            _BufferedResponse(resp.status, resp.headers, body),
+            expect_content_type='application/json',
+            json_loads=self._json_loads
+        )
+        if 'content' not in (data.get('data') or {}):
+            raise ServiceMalfunctioningError(
+                'Response data missing content field'
+            )
+        return decoder.written
+
+    _serialize = BillogramAPI._serialize
+
+    async def post(self, obj, data):
+        "Perform a HTTP POST request to the Billogram API"
+        return await self._request('POST', obj, data=self._serialize(data))
+
+    async def put(self, obj, data):
+        "Perform a HTTP PUT request to the Billogram API"
+        return await self._request('PUT', obj, data=self._serialize(data))
+
+    async def delete(self, obj):
+        "Perform a HTTP DELETE request to the Billogram API"
+        return await self._request('DELETE', obj)
+
+
+class AsyncSingletonObject(SingletonObject):
+    """Represents a remote singleton object on Billogram, asyncio version
+
+    Unlike the blocking version the object data can not be fetched lazily on
+    first access, 'await obj.refresh()' must be called before accessing it.
+    """
+    __slots__ = ()
+
+    @property
+    def data(self):
+        "Access the data of the actual object"
+        if self._data is None:
+            raise RuntimeError(
+                'Object data not loaded, await refresh() first'
+            )
+        return self._data
+
+    async def refresh(self):
+        "Refresh the local copy of the object data from remote"
+        resp = await self._api.get(self._url)
+        self._data = resp['data']
+        return self
+
+    async def update(self, data):
+        "Modify the remote object with a partial or complete structure"
+        resp = await self._api.put(self._url, data)
+        self._data = resp['data']
+        return self
+
+
+class AsyncSimpleObject(AsyncSingletonObject, SimpleObject):
+    "Represents a remote object on the Billogram service, asyncio version"
+    __slots__ = ()
+
+    async def update(self, data):
+        "Modify the remote object with a partial or complete structure"
+        url = self._url
+        await super(AsyncSimpleObject, self).update(data)
+        self._object_class._invalidate(url)
+        self._object_class._invalidate(self._url)
+        return self
+
+    async def delete(self):
+        "Remove the remote object from the database"
+        url = self._url
+        await self._api.delete(url)
+        self._object_class._invalidate(url)
+        return None
+
+
+class AsyncCompactSimpleObject(_CompactObjectMixin, AsyncSimpleObject):
+    """Compact version of AsyncSimpleObject, see Query.compact
+
+    Fields outside the projection can only be accessed after awaiting
+    refresh().
+    """
+    __slots__ = ('_projection', '_values')
+
+
+class AsyncQuery(Query):
+    """Builds queries and fetches pages of remote objects, asyncio version
+
+    The count and total_pages properties are awaitable.
+    """
+    async def _make_query(self, page_number=1, page_size=None):
+        query_args = {
+            'page_size': page_size or self._page_size,
+            'page': page_number,
+        }
+        query_args.update(self._get_queryargs())
+        filter = self._filter
+        resp = await self._type_class.api.get(
+            self._type_class._url_name,
+            query_args
+        )
+        if self._filter is filter:
+            # the count is only valid if the filter was not changed meanwhile
+            self._set_count(resp['meta']['total_count'])
+        return resp
+
+    async def _count(self):
+        count = self._get_count()
+        if count is None:
+            resp = await self._make_query(1, 1)
+            count = resp['meta']['total_count']
+        return count
+
+    async def _total_pages(self):
+        return (await self._count() + self.page_size - 1) // self.page_size
+
+    @property
+    def count(self):
+        """Total amount of objects matched by the current query, awaiting
+        this may cause a remote request"""
+        return self._count()
+
+    @property
+    def total_pages(self):
+        """Total number of pages required for all objects based on current
+        pagesize, awaiting this may cause a remote request"""
+        return self._total_pages()
+
+    async def get_page(self, page_number):
+        "Fetch objects for the one-based page number"
+        resp = await self._make_query(int(page_number))
+        return self._make_objects(resp['data'])
+
+    async def iter_all(self, max_workers=None, window=None, prefetch=None):
+        """Iterate asynchronously over all matched objects
+
+        By default pages are fetched one at a time, when needed. Pass
+        max_workers to fetch up to that many pages concurrently, or prefetch
+        to have that many pages fetched in the background ahead of the page
+        being processed. Objects are always yielded in page order.
+
+        'window' limits how many pages may be fetched ahead of the consumer,
+        counting the page being processed, as for Query.iter_all.
+        """
+        import collections
+        import copy
+        import itertools
+
+        qry = copy.copy(self)
+        current = await qry.get_page(1)
+        if self.filter == qry.filter:
+            self._count_cached = qry._count_cached
+        total_pages = await qry._total_pages()
+        if (not max_workers or max_workers <= 1) and not prefetch:
+            for obj in current:
+                yield obj
+            for page_number in range(2, total_pages+1):
+                for obj in await qry.get_page(page_number):
+                    yield obj
+            return
+        max_workers = max(max_workers or 1, 1)
+        if prefetch and not window:
+            window = prefetch + 1
+        window = max(int(window or 2 * max_workers), 1)
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def fetch(page_number):
+            async with semaphore:
+                return await qry.get_page(page_number)
+
+        pending = collections.deque()
+        page_numbers = iter(range(2, total_pages+1))
+        try:
+            while True:
+                # start fetching ahead before handing out the current page
+                ahead = max(window - 1 - len(pending), 0)
+                for page_number in itertools.islice(page_numbers, ahead):
+                    pending.append(asyncio.ensure_future(fetch(page_number)))
+                for obj in current:
+                    yield obj
+                if pending:
+                    current = await pending.popleft()
+                    continue
+                page_number = next(page_numbers, None)
+                if page_number is None:
+                    break
+                current = await fetch(page_number)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    export = _blocking_only('export')
+    iter_changed = _blocking_only('iter_changed')
+
+
+class AsyncSimpleClass(SimpleClass):
+    """Represents a collection of remote objects on the Billogram service,
+    asyncio version
+    """
+    _object_class = AsyncSimpleObject
+    _compact_object_class = AsyncCompactSimpleObject
+
+    def query(self):
+        "Create a query for objects of this type"
+        return AsyncQuery(self)
+
+    async def get(self, object_id):
+        "Fetch a single object by its identification"
+        url = self._url_of(obj_id=object_id)
+        if self.cache is not None:
+            data = self.cache.get(url)
+            if data is not None:
+                return self._object_class(self.api, self, data)
+        resp = await self.api.get(url)
+        if self.cache is not None:
+            self.cache.set(url, resp['data'])
+        return self._object_class(self.api, self, resp['data'])
+
+    async def create(self, data):
+        "Create a new object with the given data"
+        resp = await self.api.post(self.url_name, data)
+        obj = self._object_class(self.api, self, resp['data'])
+        self._invalidate(self._url_of(obj))
+        return obj
+
+    composite_query = _blocking_only('composite_query')
+    mirror = _blocking_only('mirror')
+
+
+class AsyncBillogramObject(AsyncSimpleObject, BillogramObject):
+    """Represents a billogram object on the Billogram service, asyncio version
+
+    All the event methods of BillogramObject return awaitables.
+    """
+    __slots__ = ()
+
+    async def perform_event(self, evt_name, evt_data=None):
+        """Perform a generic state transition event on billogram object
+        """
+        obj_url = self._url
+        url = '{}/command/{}'.format(obj_url, evt_name)
+        resp = await self._api.post(url, evt_data)
+        self._data = resp['data']
+        self._object_class._invalidate(obj_url)
+        return self
+
+    async def get_invoice_pdf(self, letter_id=None, invoice_no=None):
+        """Fetch the PDF content for a specific invoice on this billogram
+        """
+        import base64
+
+        url = '{}.pdf'.format(self._url)
+
+        params = {}
+        if letter_id:
+            params['letter_id'] = letter_id
+        if invoice_no:
+            params['invoice_no'] = invoice_no
+        resp = await self._api.get(
+            url,
+            params,
+            expect_content_type='application/json'
+        )
+        return base64.b64decode(resp['data']['content'])
+
+    async def get_attachment_pdf(self, letter_id=None, invoice_no=None):
+        """Fetch the PDF attachment for the billogram
+        """
+        import base64
+
+        url = '{}/attachment.pdf'.format(self._url)
+
+        resp = await self._api.get(url, expect_content_type='application/json')
+        return base64.b64decode(resp['data']['content'])
+
+    async def _save_content(self, url, params, target):
+        if not isinstance(target, str):
+            return await self._api._download_content(url, params, target)
+        import os
+        try:
+            with open(target, 'wb') as f:
+                return await self._api._download_content(url, params, f)
+        except Exception:
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+
+    async def save_invoice_pdf(self, target, letter_id=None,
+                               invoice_no=None):
+        """Download the PDF content for a specific invoice on this billogram
+        into a file
+
+        See BillogramObject.save_invoice_pdf.
+        """
+        url = '{}.pdf'.format(self._url)
+
+        params = {}
+        if letter_id:
+            params['letter_id'] = letter_id
+        if invoice_no:
+            params['invoice_no'] = invoice_no
+        return await self._save_content(url, params, target)
+
+    async def save_attachment_pdf(self, target):
+        """Download the PDF attachment for the billogram into a file
+
+        See BillogramObject.save_attachment_pdf.
+        """
+        url = '{}/attachment.pdf'.format(self._url)
+        return await self._save_content(url, None, target)
+
+    async def attach_pdf(self, filepath, filename=None):
+        """Attach a PDF to the billogram
+
+        See BillogramObject.attach_pdf.
+        """
+        body, release = self._open_pdf_attachment(filepath, filename)
+        try:
+            return await self.perform_event('attach', body)
+        finally:
+            release()
+
+
+class AsyncCompactBillogramObject(_CompactObjectMixin, AsyncBillogramObject):
+    """Compact version of AsyncBillogramObject, see Query.compact
+
+    Fields outside the projection can only be accessed after awaiting
+    refresh().
+    """
+    __slots__ = ('_projection', '_values')
+
+
+class AsyncBillogramQuery(AsyncQuery, BillogramQuery):
+    "Represents a query for billogram objects, asyncio version"
+    archive_invoice_pdfs = _blocking_only('archive_invoice_pdfs')
+
+
+class AsyncBillogramClass(AsyncSimpleClass, BillogramClass):
+    """Represents the collection of billogram objects on the Billogram
+    service, asyncio version
+    """
+    _object_class = AsyncBillogramObject
+    _compact_object_class = AsyncCompactBillogramObject
+
+    def query(self):
+        "Create a query for billogram objects"
+        return AsyncBillogramQuery(self)
+
+    composite_query = _blocking_only('composite_query')
+
+    async def perform_events(self, events, max_workers=10):
+        """Perform state transition events on many billogram objects
+
+        See BillogramClass.perform_events, up to max_workers events are
+        performed concurrently. Returns a list of BulkResult objects in the
+        same order as the events.
+        """
+        semaphore = asyncio.Semaphore(max(max_workers or 1, 1))
+
+        async def run(event):
+            obj_id, evt_name, evt_data = (tuple(event) + (None,))[:3]
+            try:
+                billogram = self._object_class(
+                    self.api,
+                    self,
+                    {self._object_id_field: obj_id}
+                )
+                async with semaphore:
+                    result = await billogram.perform_event(evt_name, evt_data)
+                return BulkResult(event, result=result)
+            except Exception as e:
+                return BulkResult(event, exception=e)
+
+        return list(await asyncio.gather(*[run(event) for event in events]))
+
+    async def create_and_send(self, data, method):
+        """Create the billogram and send it to the recipient in one operation
+
+        See BillogramClass.create_and_send.
+        """
+        assert method in ('Email', 'Letter', 'Email+Letter')
+        billogram = await self.create(data)
+        try:
+            await billogram.send(method)
+        except Exception as e:
+            await billogram.delete()
+            raise e
+        return billogram
+
+    async def create_and_send_many(self, datas, method, max_workers=10,
+                                   window=None):
+        """Create and send many billograms concurrently
+
+        See BillogramClass.create_and_send_many, up to max_workers
+        billograms are handled concurrently and 'datas' is consumed lazily,
+        at most 'window' items ahead of the consumer (twice max_workers by
+        default). This is an async generator of BulkResult objects in the
+        same order as the input.
+        """
+        import collections
+        import itertools
+
+        assert method in ('Email', 'Letter', 'Email+Letter')
+        max_workers = max(max_workers or 1, 1)
+        window = max(int(window or 2 * max_workers), 1)
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def run(data):
+            try:
+                async with semaphore:
+                    result = await self.create_and_send(data, method)
+                return BulkResult(data, result=result)
+            except Exception as e:
+                return BulkResult(data, exception=e)
+
+        datas = iter(datas)
+        pending = collections.deque()
+        try:
+            while True:
+                for data in itertools.islice(datas, window - len(pending)):
+                    pending.append(asyncio.ensure_future(run(data)))
+                if not pending:
+                    break
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def create_and_sell(self, data):
+        """Create the billogram and send it to factoring in one operation
+
+        New billogram will be in state "Factoring".
+        """
+        data['_event'] = 'sell'
+        return await self.create(data)
+
+
+__all__ = ['AsyncBillogramAPI', 'BillogramExceptions']
@@ -0,0 +1,593 @@
+#encoding=utf-8
+# Copyright (c) 2013 Billogram AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Local stand-in for the Billogram v2 API
+
+Runs an HTTP server in a background thread that emulates the parts of the
+API used by billogram_api: the billogram, customer, item and report
+collections, the settings and logotype singletons, billogram state
+transition commands and invoice and attachment PDFs. It is meant for
+benchmarks and offline testing of the client, the behaviour of the real
+service is only approximated.
+
+    standin = StandinServer(billograms=1000, latency=0.005)
+    api = BillogramAPI('user', 'key', api_base=standin.api_base)
+    ...
+    standin.close()
+"""
+from __future__ import unicode_literals, print_function, division
+
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+# event name: (states it is allowed in or None for any, resulting state)
+EVENTS = {
+    'send': (('Unattested',), 'Unpaid'),
+    'sell': (('Unattested',), 'Factoring'),
+    'resend': (('Unpaid', 'Factoring'), None),
+    'remind': (('Unpaid',), None),
+    'collect': (('Unpaid',), 'Collection'),
+    'payment': (('Unpaid',), None),
+    'credit': (('Unpaid', 'Factoring', 'Ended'), 'Credited'),
+    'writeoff': (('Unpaid', 'Collection'), 'Ended'),
+    'message': (None, None),
+    'attach': (('Unattested',), None),
+}
+
+STATES = ('Unattested', 'Unpaid', 'Paid', 'Credited', 'Ended')
+
+
+def _now():
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _field_text(data, field):
+    "Text form of a possibly dotted field of an object, as filters see it"
+    for name in field.split('.'):
+        if not isinstance(data, dict):
+            return ''
+        data = data.get(name)
+    if data is None or isinstance(data, (dict, list)):
+        return ''
+    if isinstance(data, bool):
+        return data and 'true' or 'false'
+    if isinstance(data, basestring):
+        return data
+    return '{}'.format(data)
+
+
+def _make_pdf(size):
+    "Make a fake PDF document of about size bytes"
+    head = b'%PDF-1.4\n'
+    line = b'% stand-in document content for benchmarking the client\n'
+    return head + line * max((size - len(head)) // len(line), 1)
+
+
+class _StandinError(Exception):
+    "An error response to send from the stand-in"
+    def __init__(self, http_status, status, message, headers=None):
+        super(_StandinError, self).__init__(message)
+        self.http_status = http_status
+        self.status = status
+        self.headers = headers or {}
+
+
+class StandinServer(object):
+    """Local HTTP server emulating the Billogram v2 API
+
+    The collections are filled with generated objects: 'billograms',
+    'customers' and 'items' give how many of each. All GET responses carry
+    an ETag and honour If-None-Match.
+
+    Behaviour can be tuned with:
+     - latency: seconds to wait before answering each request, or a
+       (min, max) tuple to wait a random time in between
+     - error_rate: fraction of requests answered with error_status instead,
+       429 errors carry a Retry-After header
+     - max_page_size: largest page_size accepted by queries, larger ones
+       are rejected like the real service does
+     - pdf_size: size in bytes of the PDF documents served
+    Call fail_next to have the next few requests fail deterministically.
+
+    Served requests and response body bytes are counted in the requests
+    and body_bytes attributes, and opened connections in connections.
+    """
+    def __init__(self, billograms=100, customers=10, items=10, latency=0,
+                 error_rate=0, error_status=503, max_page_size=100,
+                 pdf_size=50 * 1024, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_page_size = max_page_size
+        self.requests = 0
+        self.body_bytes = 0
+        self.connections = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._fail = []
+        self._pdf = base64.b64encode(_make_pdf(pdf_size)).decode('ascii')
+        self._collections = {
+            'customer': ('customer_no', {}),
+            'item': ('item_no', {}),
+            'billogram': ('id', {}),
+            'report': ('filename', {}),
+        }
+        for n in range(1, customers + 1):
+            self._add('customer', self._make_customer(n))
+        for n in range(1, items + 1):
+            self._add('item', self._make_item(n))
+        for n in range(1, billograms + 1):
+            self._add('billogram', self._make_billogram(n, customers, items))
+        for n in range(1, 4):
+            self._add('report', self._make_report(n))
+        self._singletons = {
+            'settings': {
+                'name': 'Example AB',
+                'org_no': '556677-8899',
+                'contact': {'name': 'Some Body', 'email': 'info@example.com'},
+                'invoices': {'default_message': 'Thank you! ' * 50},
+            },
+            'logotype': {
+                'content': base64.b64encode(
+                    b'\x89PNG' * 10000
+                ).decode('ascii'),
+                'file_type': 'image/png',
+            },
+        }
+
+        self.server = _Server(('127.0.0.1', 0), _make_handler(self))
+        self.api_base = 'http://127.0.0.1:{}/api/v2'.format(
+            self.server.server_address[1]
+        )
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        "Stop the server"
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail_next(self, count=1, status=503):
+        "Answer the next count requests with an error of the given status"
+        with self._lock:
+            self._fail.extend([status] * count)
+
+    def reset_counters(self):
+        "Reset the request, body byte and connection counters"
+        with self._lock:
+            self.requests = self.body_bytes = self.connections = 0
+
+    def ids(self, url_name):
+        "The identifications of all objects in a collection"
+        with self._lock:
+            return sorted(self._collections[url_name][1])
+
+    def _add(self, url_name, data):
+        id_field, objects = self._collections[url_name]
+        objects['{}'.format(data[id_field])] = data
+
+    def _make_customer(self, n):
+        return {
+            'customer_no': n,
+            'name': 'Customer number {}'.format(n),
+            'company_type': 'business',
+            'org_no': '55{:08d}'.format(n),
+            'contact': {
+                'name': 'Contact {}'.format(n),
+                'email': 'customer{}@example.com'.format(n),
+                'phone': '08-123 456 78',
+            },
+            'address': {
+                'street_address': 'Exempelgatan {}'.format(n),
+                'zipcode': '123 45',
+                'city': 'Stockholm',
+                'country': 'SE',
+            },
+            'created_at': '2013-05-01 12:00:00',
+            'updated_at': '2013-05-01 12:00:00',
+        }
+
+    def _make_item(self, n):
+        return {
+            'item_no': '{}'.format(n),
+            'title': 'Item number {}'.format(n),
+            'description': 'Description of item {}'.format(n),
+            'price': 100.0 + n,
+            'vat': 25,
+            'unit': 'unit',
+            'created_at': '2013-05-01 12:00:00',
+            'updated_at': '2013-05-01 12:00:00',
+        }
+
+    def _make_billogram(self, n, customers, items):
+        customer = self._collections['customer'][1].get(
+            '{}'.format(customers and n % customers + 1)
+        )
+        item = self._collections['item'][1].get(
+            '{}'.format(items and n % items + 1)
+        )
+        total = 1250.0 + n
+        return {
+            'id': 'bg{:08d}'.format(n),
+            'invoice_no': n,
+            'ocr_number': '{:012d}'.format(n * 7),
+            'state': STATES[n % len(STATES)],
+            'currency': 'SEK',
+            'total_sum': total,
+            'remaining_sum': total,
+            'invoice_date': '2013-05-01',
+            'due_date': '2013-05-31',
+            'created_at': '2013-05-01 12:00:00',
+            'updated_at': '2013-05-{:02d} 12:00:00'.format(n % 28 + 1),
+            'customer': customer and {
+                'customer_no': customer['customer_no'],
+                'name': customer['name'],
+                'email': customer['contact']['email'],
+            } or {},
+            'items': item and [dict(item, count=1)] or [],
+            'events': [],
+            'url': 'https://billogram.com/invoice/bg{:08d}'.format(n),
+        }
+
+    def _make_report(self, n):
+        content = ''.join(
+            'bg{:08d};{}\n'.format(i, 1250 + i) for i in range(100)
+        )
+        return {
+            'filename': 'report{}.csv'.format(n),
+            'file_type': 'text/csv',
+            'created_at': '2013-05-01 12:00:00',
+            'content': base64.b64encode(
+                content.encode('ascii')
+            ).decode('ascii'),
+        }
+
+    def _delay(self):
+        if isinstance(self.latency, (tuple, list)):
+            return self._random.uniform(*self.latency)
+        return self.latency
+
+    def _injected_error(self):
+        "Status of an error to inject for this request, or None"
+        with self._lock:
+            if self._fail:
+                return self._fail.pop(0)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self.error_status
+        return None
+
+    def handle(self, method, path, query, body):
+        """Handle an API request, returning the HTTP status, response data
+        and any extra headers"""
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+        status = self._injected_error()
+        if status is not None:
+            headers = {}
+            if status == 429:
+                headers['retry-after'] = '0'
+            raise _StandinError(
+                status,
+                'SERVICE_UNAVAILABLE',
+                'Injected error',
+                headers
+            )
+        parts = path.split('/')
+        if len(parts) == 1 and parts[0] in self._singletons:
+            return self._singleton(method, parts[0], body)
+        if parts[0] not in self._collections:
+            raise _StandinError(404, 'NOT_FOUND', 'No such endpoint')
+        if len(parts) == 1:
+            if method == 'GET':
+                return self._query(parts[0], query)
+            if method == 'POST':
+                return self._create(parts[0], body)
+        elif len(parts) == 2 and parts[0] == 'billogram' and \
+                parts[1].endswith('.pdf') and method == 'GET':
+            self._get(parts[0], parts[1][:-len('.pdf')])
+            return self._pdf_response()
+        elif len(parts) == 2:
+            if method == 'GET':
+                return {'status': 'OK', 'data': self._get(*parts)}
+            if method == 'PUT':
+                return self._update(parts[0], parts[1], body)
+            if method == 'DELETE':
+                return self._delete(*parts)
+        elif len(parts) == 3 and parts[0] == 'billogram' and \
+                parts[2] == 'attachment.pdf' and method == 'GET':
+            self._get(parts[0], parts[1])
+            return self._pdf_response()
+        elif len(parts) == 4 and parts[0] == 'billogram' and \
+                parts[2] == 'command' and method == 'POST':
+            return self._command(parts[1], parts[3], body)
+        raise _StandinError(405, 'INVALID_METHOD', 'Invalid HTTP method')
+
+    def _singleton(self, method, name, body):
+        with self._lock:
+            if method == 'PUT':
+                self._singletons[name].update(body or {})
+            elif method != 'GET':
+                raise _StandinError(405, 'INVALID_METHOD', 'Invalid method')
+            return {'status': 'OK', 'data': self._singletons[name]}
+
+    def _query(self, url_name, query):
+        try:
+            page = int(query.get('page', 1))
+            page_size = int(query.get('page_size', 100))
+        except ValueError:
+            raise _StandinError(
+                400,
+                'INVALID_QUERY_PARAMETER',
+                'Invalid page or page_size'
+            )
+        if page < 1 or page_size < 1 or \
+                self.max_page_size and page_size > self.max_page_size:
+            raise _StandinError(
+                400,
+                'INVALID_QUERY_PARAMETER',
+                'Invalid page or page_size'
+            )
+        with self._lock:
+            objects = list(self._collections[url_name][1].values())
+        filter_type = query.get('filter_type')
+        if filter_type:
+            field = query.get('filter_field', '')
+            value = query.get('filter_value', '')
+            if filter_type == 'field' and field == 'state':
+                states = value.split(',')
+                objects = [o for o in objects if o.get('state') in states]
+            elif filter_type == 'field':
+                objects = [
+                    o for o in objects if _field_text(o, field) == value
+                ]
+            elif filter_type == 'field-prefix':
+                value = value.lower()
+                objects = [
+                    o for o in objects
+                    if _field_text(o, field).lower().startswith(value)
+                ]
+            elif filter_type == 'field-search':
+                value = value.lower()
+                objects = [
+                    o for o in objects
+                    if value in _field_text(o, field).lower()
+                ]
+            elif filter_type == 'special' and field == 'search':
+                value = value.lower()
+                objects = [
+                    o for o in objects
+                    if value in json.dumps(o, sort_keys=True).lower()
+                ]
+            else:
+                raise _StandinError(
+                    400,
+                    'INVALID_QUERY_PARAMETER',
+                    'Unsupported filter'
+                )
+        order_field = query.get('order_field')
+        if order_field:
+            objects.sort(
+                key=lambda o: _field_text(o, order_field),
+                reverse=query.get('order_direction') == 'desc'
+            )
+        else:
+            id_field = self._collections[url_name][0]
+            objects.sort(key=lambda o: o[id_field])
+        start = (page - 1) * page_size
+        return {
+            'status': 'OK',
+            'meta': {'total_count': len(objects)},
+            'data': objects[start:start + page_size],
+        }
+
+    def _get(self, url_name, object_id):
+        with self._lock:
+            data = self._collections[url_name][1].get(object_id)
+        if data is None:
+            raise _StandinError(404, 'NOT_FOUND', 'Object not found')
+        return data
+
+    def _create(self, url_name, body):
+        id_field, objects = self._collections[url_name]
+        if not isinstance(body, dict):
+            raise _StandinError(400, 'INVALID_PARAMETER', 'Missing data')
+        with self._lock:
+            data = dict(body)
+            if url_name == 'billogram':
+                data['id'] = 'bg{:08d}'.format(len(objects) + 1)
+                data.setdefault('state', 'Unattested')
+                data.setdefault('events', [])
+            elif id_field not in data:
+                data[id_field] = len(objects) + 1
+            data['created_at'] = data['updated_at'] = _now()
+            if '{}'.format(data[id_field]) in objects:
+                raise _StandinError(
+                    400,
+                    'INVALID_PARAMETER',
+                    'Object already exists'
+                )
+            self._add(url_name, data)
+        return {'status': 'OK', 'data': data}
+
+    def _update(self, url_name, object_id, body):
+        with self._lock:
+            data = self._collections[url_name][1].get(object_id)
+            if data is None:
+                raise _StandinError(404, 'NOT_FOUND', 'Object not found')
+            data = dict(data, **(body or {}))
+            data['updated_at'] = _now()
+            self._collections[url_name][1][object_id] = data
+        return {'status': 'OK', 'data': data}
+
+    def _delete(self, url_name, object_id):
+        with self._lock:
+            if self._collections[url_name][1].pop(object_id, None) is None:
+                raise _StandinError(404, 'NOT_FOUND', 'Object not found')
+        return {'status': 'OK', 'data': None}
+
+    def _command(self, object_id, event, body):
+        if event not in EVENTS:
+            raise _StandinError(400, 'INVALID_PARAMETER', 'Unknown event')
+        allowed, new_state = EVENTS[event]
+        with self._lock:
+            data = self._collections['billogram'][1].get(object_id)
+            if data is None:
+                raise _StandinError(404, 'NOT_FOUND', 'Object not found')
+            if allowed is not None and data['state'] not in allowed:
+                raise _StandinError(
+                    400,
+                    'INVALID_OBJECT_STATE',
+                    'Event not allowed in state {}'.format(data['state'])
+                )
+            data = dict(data, events=data['events'] + [{
+                'type': event,
+                'created_at': _now(),
+                'data': event != 'attach' and body or None,
+            }])
+            if event == 'payment':
+                data['remaining_sum'] -= (body or {}).get('amount', 0)
+                if data['remaining_sum'] <= 0:
+                    new_state = 'Paid'
+            if new_state:
+                data['state'] = new_state
+            data['updated_at'] = _now()
+            self._collections['billogram'][1][object_id] = data
+        return {'status': 'OK', 'data': data}
+
+    def _pdf_response(self):
+        return {
+            'status': 'OK',
+            'data': {'content': self._pdf, 'file_type': 'application/pdf'},
+        }
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _make_handler(standin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            with standin._lock:
+                standin.connections += 1
+
+        def log_message(self, *args):
+            pass
+
+        def _read_body(self):
+            if self.headers.get('transfer-encoding') == 'chunked':
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    if not size:
+                        self.rfile.readline()
+                        break
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+                raw = b''.join(chunks)
+            else:
+                raw = self.rfile.read(
+                    int(self.headers.get('content-length') or 0)
+                )
+            return raw and json.loads(raw.decode('utf-8')) or None
+
+        def _handle(self):
+            url = urlparse(self.path)
+            path = url.path.split('/api/v2/', 1)[-1].strip('/')
+            headers = {}
+            try:
+                body = self._read_body()
+                status = 200
+                data = standin.handle(
+                    self.command,
+                    path,
+                    dict(parse_qsl(url.query)),
+                    body
+                )
+            except _StandinError as e:
+                status = e.http_status
+                headers = e.headers
+                data = {
+                    'status': e.status,
+                    'data': {'message': '{}'.format(e)},
+                }
+            except ValueError:
+                status = 400
+                data = {
+                    'status': 'INVALID_PARAMETER',
+                    'data': {'message': 'Invalid JSON'},
+                }
+            content = json.dumps(data).encode('utf-8')
+            with standin._lock:
+                standin.requests += 1
+            if self.command == 'GET' and status == 200:
+                etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+                headers['etag'] = etag
+                if self.headers.get('if-none-match') == etag:
+                    self.send_response(304)
+                    self.send_header('etag', etag)
+                    self.send_header('content-length', '0')
+                    self.end_headers()
+                    return
+            with standin._lock:
+                standin.body_bytes += len(content)
+            self.send_response(status)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', '{}'.format(len(content)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    return Handler